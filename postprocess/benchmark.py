@@ -0,0 +1,397 @@
+#!/usr/bin/python2
+
+'''
+Created on October 19, 2026
+
+@author: periwinklepreacher
+
+program name: benchmark
+ description: Measure postprocess end-to-end against synthetic mega-packs without
+              real downloads or a real file server.
+
+              Each scenario generates a pack in a scratch directory (nested folders,
+              CD1/CD2 stacks, multi-volume and nested archives made with the local
+              archive program, hundreds of small zips, thousands of tiny meta
+              files) and then runs postprocess.main( ) against it. Storage is a
+              set of local directories and StorageService points at a local HTTP
+              stand-in that serves the same JSON as storaged.py.
+
+              Reported per scenario: wall time, time per phase, bytes copied per
+              second, number of subprocesses launched and peak disk use of the
+              scratch file system.
+
+              Phase times and counters come from the postprocess run trace, so they
+              are inclusive, e.g. sandbox time is also counted in extract.
+
+       usage: python benchmark.py --scenario nested --scenario multivolume --scale 4
+              python benchmark.py --archive-program "C:\Program Files\7-Zip\7z.exe" --json bench.json
+
+Copyright (C) 2026  periwinklepreacher.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import OrderedDict
+import argparse
+import distutils.spawn
+import logging
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+
+import postprocess
+
+
+class DiskMonitor( threading.Thread ):
+    ''' Sample used space of the file system holding path and keep the peak above the starting point. Needs statvfs,
+        so peak is None on Windows.
+    '''
+    def __init__( self, path, interval = 0.05 ):
+        threading.Thread.__init__( self )
+        self.daemon = True
+        self.path = path
+        self.interval = interval
+        self.baseline = self.used( )
+        self.peak = self.baseline
+        self._finished = threading.Event( )
+
+    def used( self ):
+        if not hasattr( os, 'statvfs' ):
+            return None
+        stinfo = os.statvfs( self.path )
+        return ( stinfo.f_blocks - stinfo.f_bfree ) * stinfo.f_frsize
+
+    def run( self ):
+        while not self._finished.wait( self.interval ):
+            self.peak = max( self.peak, self.used( ) )
+
+    def stop( self ):
+        self._finished.set( )
+        self.join( )
+        if self.baseline is None:
+            return None
+        self.peak = max( self.peak, self.used( ) )
+        return self.peak - self.baseline
+
+
+class StorageStandIn( HTTPServer ):
+    ''' Local replacement for the file server StorageService. Serves the storaged.py JSON format for every directory
+        in disk_list, reporting each one as mounted under /share.
+    '''
+    prefix = '/share'
+
+    def __init__( self, disk_list ):
+        HTTPServer.__init__( self, ( '127.0.0.1', 0 ), StorageHandler )
+        self.disk_list = disk_list
+        self.requests = 0
+        self.thread = threading.Thread( target = self.serve_forever )
+        self.thread.daemon = True
+        self.thread.start( )
+
+    @property
+    def url( self ):
+        return 'http://{}:{}/disks.json'.format( *self.server_address )
+
+    def disks( self ):
+        disk_list = [ ]
+        for disk in self.disk_list:
+            stinfo = os.statvfs( disk )
+            size = stinfo.f_blocks * stinfo.f_frsize // 1024
+            available = stinfo.f_bavail * stinfo.f_frsize // 1024
+            disk_list.append( { 'device' : 'bench', 'size' : size, 'used' : size - available,
+                                'available' : available, 'use' : '0%',
+                                'mount' : '/'.join( [ self.prefix, os.path.basename( disk ) ] ) } )
+        return disk_list
+
+    def close( self ):
+        self.shutdown( )
+        self.server_close( )
+
+
+class StorageHandler( BaseHTTPRequestHandler ):
+    def do_GET( self ):
+        self.server.requests += 1
+        body = json.dumps( self.server.disks( ) )
+        self.send_response( 200 )
+        self.send_header( 'Content-Type', 'application/json' )
+        self.send_header( 'Content-Length', str( len( body ) ) )
+        self.end_headers( )
+        self.wfile.write( body )
+
+    def log_message( self, *args ):
+        pass
+
+
+class PackBuilder:
+    ''' Generate synthetic packs. Media files are filled with random bytes so that the archive program cannot cheat
+        by compressing them away.
+    '''
+    def __init__( self, root, zip_program, media_size, scale ):
+        self.root = root
+        self.zip_program = zip_program
+        self.media_size = media_size
+        self.scale = scale
+
+    def folder( self, path ):
+        if not os.path.isdir( path ):
+            os.makedirs( path )
+
+    def write( self, fullname, size ):
+        self.folder( os.path.dirname( fullname ) )
+        with open( fullname, 'wb' ) as f:
+            while size > 0:
+                chunk = min( size, 1 << 20 )
+                f.write( os.urandom( chunk ) )
+                size -= chunk
+
+    def archive( self, archive, source, volume = None ):
+        ''' Add the contents of source to archive with the archive program, optionally split into volumes of volume
+            bytes.
+        '''
+        cmd = [ self.zip_program, 'a', '-bd', '-y' ]
+        if volume:
+            cmd.append( '-v{}b'.format( volume ) )
+        cmd.extend( [ archive, os.path.join( source, '*' ) ] )
+        with open( os.devnull, 'wb' ) as devnull:
+            subprocess.check_call( cmd, stdout = devnull, stderr = subprocess.STDOUT )
+
+    def staging( self, name ):
+        return tempfile.mkdtemp( prefix = name, dir = self.root )
+
+    def nested( self, pack ):
+        for i in range( 2 * self.scale ):
+            folder = os.path.join( pack, 'Season.{:02d}'.format( i ), 'Extras', 'Deep' )
+            self.write( os.path.join( pack, 'Season.{:02d}'.format( i ), 'Episode.{:02d}.mkv'.format( i ) ), self.media_size )
+            self.write( os.path.join( folder, 'Featurette.{:02d}.mkv'.format( i ) ), self.media_size // 4 )
+            self.write( os.path.join( folder, 'Featurette.{:02d}.nfo'.format( i ) ), 512 )
+            self.write( os.path.join( folder, 'sample-{:02d}.mkv'.format( i ) ), 4096 )
+
+    def stacked( self, pack ):
+        for i in range( self.scale ):
+            for cd in ( 1, 2 ):
+                folder = os.path.join( pack, 'Movie.{}.2010.CD{}'.format( i, cd ) )
+                self.write( os.path.join( folder, 'movie.{}.avi'.format( i ) ), self.media_size )
+                self.write( os.path.join( folder, 'movie.{}.srt'.format( i ) ), 2048 )
+
+    def multivolume( self, pack ):
+        for i in range( self.scale ):
+            staging = self.staging( 'multivolume' )
+            for j in range( 4 ):
+                self.write( os.path.join( staging, 'Part.{}.{}.mkv'.format( i, j ) ), self.media_size )
+            self.write( os.path.join( staging, 'Part.{}.nfo'.format( i ) ), 512 )
+            self.folder( pack )
+            self.archive( os.path.join( pack, 'Pack.{}.7z'.format( i ) ), staging, volume = self.media_size )
+            shutil.rmtree( staging )
+
+    def nested_archive( self, pack ):
+        for i in range( self.scale ):
+            inner = self.staging( 'inner' )
+            outer = self.staging( 'outer' )
+            for j in range( 2 ):
+                self.write( os.path.join( inner, 'Inner.{}.{}.mkv'.format( i, j ) ), self.media_size )
+            self.archive( os.path.join( outer, 'Inner.{}.zip'.format( i ) ), inner )
+            self.write( os.path.join( outer, 'Outer.{}.mkv'.format( i ) ), self.media_size )
+            self.folder( pack )
+            self.archive( os.path.join( pack, 'Outer.{}.7z'.format( i ) ), outer )
+            shutil.rmtree( inner )
+            shutil.rmtree( outer )
+
+    def sandbox( self, pack ):
+        for i in range( self.scale ):
+            staging = self.staging( 'sandbox' )
+            self.write( os.path.join( staging, 'keygen.exe' ), 65536 )
+            self.write( os.path.join( staging, 'Setup.{}.iso'.format( i ) ), self.media_size )
+            self.folder( pack )
+            self.archive( os.path.join( pack, 'Software.{}.zip'.format( i ) ), staging )
+            shutil.rmtree( staging )
+
+    def small_zips( self, pack ):
+        ''' Hundreds of small zip files built with zipfile, so this scenario needs no archive program.
+        '''
+        self.folder( pack )
+        for i in range( 100 * self.scale ):
+            with zipfile.ZipFile( os.path.join( pack, 'Issue.{:04d}.zip'.format( i ) ), 'w', zipfile.ZIP_DEFLATED ) as z:
+                z.writestr( 'Issue.{:04d}.cbz'.format( i ), os.urandom( 32768 ) )
+                z.writestr( 'Issue.{:04d}.nfo'.format( i ), 'nfo' * 64 )
+
+    def tiny_meta( self, pack ):
+        for i in range( 100 * self.scale ):
+            folder = os.path.join( pack, 'Album.{:04d}'.format( i ) )
+            self.write( os.path.join( folder, 'track.mp3' ), 16384 )
+            for j in range( 20 ):
+                ext = ( '.nfo', '.jpg', '.txt', '.srt' )[ j % 4 ]
+                self.write( os.path.join( folder, 'meta.{:02d}{}'.format( j, ext ) ), 128 )
+
+
+SCENARIOS = OrderedDict( [
+    ( 'nested', False ),
+    ( 'stacked', False ),
+    ( 'tiny_meta', False ),
+    ( 'small_zips', False ),
+    ( 'multivolume', True ),
+    ( 'nested_archive', True ),
+    ( 'sandbox', True ) ] )
+
+CONFIG = '''[Default]
+ArchiveProgram = {zip_program}
+ArchiveBackend = {archive_backend}
+LowPriorityIO = {low_priority_io}
+ArchiveExtensions = .zip, .rar, .7z, .gz, .bz, .tar, .001
+MediaExtensions = .mkv, .avi, .mp3, .iso, .cbz
+MetaExtensions = .nfo, .jpg, .gif, .png, .txt
+SubtitleExtensions = .sub, .idx, .srt
+IgnoreWords = sample, .!ut, ~uTorrentPartFile
+MediaSandbox = keygen.exe
+SandboxPassword = secret
+IncludeSubtitles = yes
+IncludeMeta = yes
+FlattenFolders = no
+FlattenStacked = yes
+StackedRegex = (?P<tag>\\bcd|\\bpart|\\bdisc|\\bdisk|\\bdvd|\\bpt).?(?P<sequence>\\d+)
+MakeParent = no
+Storage = {storage}
+StorageService = {service}
+StorageMap = {prefix} {storage_root}
+'''
+
+
+SCRATCH = [ 'source', 'storage', 'tmp', 'reports', 'bench.ini', 'postprocess.log' ]
+
+def remove_scratch( root, existing ):
+    ''' Remove what the benchmark created in a caller-supplied root, leaving everything that was already there.
+    '''
+    for name in SCRATCH:
+        path = os.path.join( root, name )
+        if name in existing or not os.path.exists( path ):
+            continue
+        if os.path.isdir( path ):
+            shutil.rmtree( path, ignore_errors = True )
+        else:
+            os.remove( path )
+
+def run_scenario( args, root, scenario, service, disk_list ):
+    ''' Build the pack for scenario, run postprocess against it and return the measurements as a dictionary.
+    '''
+    source = os.path.join( root, 'source', scenario )
+    builder = PackBuilder( root, args.archive_program, args.media_size, args.scale )
+    getattr( builder, scenario )( source )
+
+    storage_root = os.path.dirname( disk_list[0] )
+    ini = os.path.join( root, 'bench.ini' )
+    with open( ini, 'w' ) as f:
+        f.write( CONFIG.format( zip_program = args.archive_program or '7z',
+                                archive_backend = args.archive_backend,
+                                low_priority_io = 'yes' if args.low_priority_io else 'no',
+                                storage = os.path.join( storage_root, 'disk??' ),
+                                service = service.url,
+                                prefix = StorageStandIn.prefix,
+                                storage_root = storage_root ) )
+    for disk in disk_list:
+        shutil.rmtree( disk )
+        os.makedirs( disk )
+
+    postprocess.Storage._storage_list = None
+    service.requests = 0
+    monitor = DiskMonitor( root )
+    monitor.start( )
+    start = time.time( )
+    postprocess.main( [ '-c', ini, '-f', '', '-d', source, '-l', 'Bench', '-i', scenario,
+                        '--logfile', os.path.join( root, 'postprocess.log' ),
+                        '--report', os.path.join( root, 'reports' ),
+                        '--manifest', '' ] )
+    wall = time.time( ) - start
+    peak = monitor.stop( )
+    logging.getLogger( ).handlers = [ ]
+    shutil.rmtree( source )
+
+    counters = postprocess.trace.counters
+    return OrderedDict( [
+        ( 'scenario', scenario ),
+        ( 'wall', wall ),
+        ( 'phases', OrderedDict( ( phase, entry[ 'seconds' ] ) for phase, entry in postprocess.trace.phases.items( ) ) ),
+        ( 'files_copied', counters[ 'files_copied' ] ),
+        ( 'bytes_copied', counters[ 'bytes_copied' ] ),
+        ( 'bytes_per_second', counters[ 'bytes_copied' ] / wall if wall else 0.0 ),
+        ( 'bytes_read', counters[ 'bytes_read' ] ),
+        ( 'bytes_written', counters[ 'bytes_written' ] ),
+        ( 'subprocesses', counters[ 'subprocesses' ] ),
+        ( 'storage_requests', service.requests ),
+        ( 'peak_disk', peak ),
+        ( 'page_cache_kb', postprocess.trace.page_cache ) ] )
+
+def print_report( results ):
+    phases = results[0][ 'phases' ].keys( ) if results else [ ]
+    header = '{:<16}{:>9}{:>7}{:>10}{:>7}{:>11}'.format( 'scenario', 'wall', 'files', 'MB/s', 'procs', 'peak MB' )
+    print( header + ''.join( '{:>9}'.format( phase ) for phase in phases ) )
+    for result in results:
+        peak = result[ 'peak_disk' ]
+        line = '{:<16}{:>9.3f}{:>7}{:>10.1f}{:>7}{:>11}'.format(
+            result[ 'scenario' ], result[ 'wall' ], result[ 'files_copied' ], result[ 'bytes_per_second' ] / 2**20,
+            result[ 'subprocesses' ], '{:.1f}'.format( peak / 2.0**20 ) if peak is not None else '-' )
+        print( line + ''.join( '{:>9.3f}'.format( result[ 'phases' ][ phase ] ) for phase in phases ) )
+
+def main( ):
+    parser = argparse.ArgumentParser( description = "Benchmark postprocess against synthetic packs." )
+    parser.add_argument( '--scenario', action = 'append', choices = SCENARIOS.keys( ), help = "Scenario to run (repeatable). Default is all." )
+    parser.add_argument( '--scale', type = int, default = 1, help = "Multiplier for the number of files in each pack." )
+    parser.add_argument( '--media-size', dest = 'media_size', type = int, default = 4 << 20, help = "Size in bytes of each synthetic media file." )
+    parser.add_argument( '--archive-program', dest = 'archive_program', default = distutils.spawn.find_executable( '7z' ), help = "7-Zip executable used to build and extract archives." )
+    parser.add_argument( '--archive-backend', dest = 'archive_backend', choices = [ 'auto', 'external' ], default = 'auto', help = "ArchiveBackend setting passed to postprocess." )
+    parser.add_argument( '--low-priority-io', dest = 'low_priority_io', action = 'store_true', default = False, help = "LowPriorityIO setting passed to postprocess." )
+    parser.add_argument( '--repeat', type = int, default = 1, help = "Run each scenario this many times." )
+    parser.add_argument( '--root', default = None, help = "Scratch directory (default is a new temporary directory)." )
+    parser.add_argument( '--keep', action = 'store_true', default = False, help = "Don't delete the scratch directory." )
+    parser.add_argument( '--json', default = None, help = "Write the results to this file as JSON." )
+    args = parser.parse_args( )
+
+    root = args.root or tempfile.mkdtemp( prefix = 'ppbench' )
+    existing = set( name for name in SCRATCH if os.path.exists( os.path.join( root, name ) ) ) if args.root else set( )
+    workspace = os.path.join( root, 'tmp' )
+    disk_list = [ os.path.join( root, 'storage', 'disk{:02d}'.format( i ) ) for i in range( 1, 3 ) ]
+    for folder in [ workspace ] + disk_list:
+        if not os.path.isdir( folder ):
+            os.makedirs( folder )
+    tempfile.tempdir = workspace
+
+    service = StorageStandIn( disk_list )
+    results = [ ]
+    try:
+        for scenario in args.scenario or SCENARIOS.keys( ):
+            if SCENARIOS[ scenario ] and not args.archive_program:
+                sys.stderr.write( 'Skipping {}: no archive program found.\n'.format( scenario ) )
+                continue
+            for i in range( args.repeat ):  # @UnusedVariable
+                results.append( run_scenario( args, root, scenario, service, disk_list ) )
+    finally:
+        service.close( )
+        tempfile.tempdir = None
+        if not args.keep and not args.root:
+            shutil.rmtree( root, ignore_errors = True )
+        elif not args.keep:
+            remove_scratch( root, existing )
+
+    print_report( results )
+    if args.json:
+        with open( args.json, 'w' ) as f:
+            json.dump( results, f, indent = 2 )
+
+if __name__ == "__main__":
+    main( )
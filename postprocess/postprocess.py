@@ -26,10 +26,19 @@ program name: postprocess
               so that files can be copied to volumes with the most amount of
               free space.
               
+              Copies can be rate limited per label (CopyRate) and across every
+              postprocess running on the host (GlobalCopyRate), with time of day
+              profiles similar to the uTorrent scheduler (CopySchedule and
+              GlobalCopySchedule), e.g.
+                  CopySchedule = mon-fri 08:00-18:00 2M, 23:00-07:00 unlimited, sun 12:00-14:00 0
+              
        usage: uTorrent > Preferences > Advanced > Run Program > Run this program when a torrent finishes:
              "C:\Python27\python.exe" "C:\Program Files\PostProcess\postprocess.py" \
                  -f "%F" -d "%D" -t "%N" -s "%S" -l "%L" -m "%M" -i "%I"
 
+    optional: scandir package (pip install scandir). Python 2.7 has no os.scandir; with the package a folder scan
+              reads file types from the directory listing, without it each entry costs one stat call.
+
 Tested using SABnzbd 0.7.20, uTorrent 2.2.1, python 2.7.10, Windows XP 2002 SP3
 
 Copyright (C) 2015  periwinklepreacher.
@@ -49,17 +58,30 @@ Copyright (C) 2015  periwinklepreacher.
 '''
 
 from ConfigParser import SafeConfigParser
+from StringIO import StringIO
+from collections import OrderedDict
 import argparse
+import bz2
+import cProfile
+import contextlib
+import fnmatch
 import glob
-import itertools
+import gzip
+import hashlib
 import logging
 import os.path
+import pstats
 import re
 import shutil
+import stat
 import subprocess
 import sys
+import tarfile
 import tempfile
-import urllib, json
+import time
+import urllib2, json
+import zipfile
+from distutils.spawn import find_executable
 
 
 try:
@@ -67,9 +89,48 @@ try:
 except ImportError:
     from os import statvfs                    # @UnusedImport
 
+try:
+    from os import scandir                    # @UnusedImport
+except ImportError:
+    try:
+        from scandir import scandir           # @UnusedImport
+    except ImportError:
+        scandir = None
+
+try:
+    import fcntl
+
+    def lock_file( f ):
+        fcntl.flock( f.fileno( ), fcntl.LOCK_EX )
+
+    def unlock_file( f ):
+        fcntl.flock( f.fileno( ), fcntl.LOCK_UN )
+except ImportError:
+    import msvcrt
+
+    def lock_file( f ):
+        f.seek( 0 )
+        msvcrt.locking( f.fileno( ), msvcrt.LK_LOCK, 1 )
+
+    def unlock_file( f ):
+        f.seek( 0 )
+        msvcrt.locking( f.fileno( ), msvcrt.LK_UNLCK, 1 )
+
+posix_fadvise = None
+ionice = None
+if sys.platform.lower( ).startswith( 'linux' ):
+    try:
+        import ctypes.util
+        libc = ctypes.CDLL( ctypes.util.find_library( 'c' ), use_errno = True )
+        posix_fadvise = getattr( libc, 'posix_fadvise64', None ) or libc.posix_fadvise
+        posix_fadvise.argtypes = [ ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int ]
+    except ( ImportError, OSError, AttributeError ):
+        posix_fadvise = None
+    ionice = find_executable( 'ionice' )
+
 
 class CommandLine( argparse.Namespace ):
-    def __init__( self ):
+    def __init__( self, argv = None ):
         program_name, program_ext = os.path.splitext( os.path.basename( sys.argv[0] ) )  # @UnusedVariable
         program_path = os.path.dirname( sys.argv[0] )
 
@@ -79,6 +140,8 @@ class CommandLine( argparse.Namespace ):
         log_folder = os.path.join( os.sep, 'var', 'log' ) if sys.platform.lower().startswith( 'linux' ) else tempfile.gettempdir( )
         log_default = os.path.join( log_folder, '{}.log'.format( program_name ) )
         config_default = os.path.join( program_path, program_name + '.ini' )
+        report_default = os.path.join( log_folder, '{}-reports'.format( program_name ) )
+        manifest_default = os.path.join( log_folder, '{}-manifest'.format( program_name ) )
 
         parser = argparse.ArgumentParser( )
         parser.add_argument( '-c', "--config", required = False, default = config_default, help = "INI configuration file." )
@@ -92,6 +155,9 @@ class CommandLine( argparse.Namespace ):
         parser.add_argument( '--level', dest = 'level', choices = log_level.keys(), required = False, default = 'warning', help = "Console messages are filtered by this severity." )
         parser.add_argument( '--logfile', dest = 'logfile', required = False, default = log_default, help = "Name of the log file. The log file is not filtered by the level setting." )
         parser.add_argument( '--pretend', dest = 'pretend', required = False, default = False, action = 'store_true', help = "Don't actually transfer the file to the storage server." )
+        parser.add_argument( '--report', dest = 'report', required = False, default = report_default, help = "Folder for the JSON run report, named by label and infohash. Empty to disable." )
+        parser.add_argument( '--manifest', dest = 'manifest', required = False, default = manifest_default, help = "Folder of per-infohash manifests used to skip files already processed. Empty to disable." )
+        parser.add_argument( '--profile', dest = 'profile', required = False, default = False, action = 'store_true', help = "Run under cProfile and save the statistics next to the run report." )
 
         log = logging.getLogger( )
         log.setLevel( log_level[ 'all' ] )
@@ -101,7 +167,7 @@ class CommandLine( argparse.Namespace ):
         log.addHandler( log_to_console )
 
         try:
-            parser.parse_args( namespace = self )
+            parser.parse_args( argv, namespace = self )
         except:
             log.critical( ' '.join( sys.argv ) )    
             exit( -1 )
@@ -116,14 +182,14 @@ class CommandLine( argparse.Namespace ):
         if self.level:
             log_to_console.setLevel( log_level[ self.level ] )
             
-        log.info( ' '.join( sys.argv ) )
+        log.info( ' '.join( sys.argv if argv is None else sys.argv[:1] + argv ) )
 
 
 class Configuration:
     ''' Load configuration settings from a file.
     '''
-    def __init__( self ):
-        self.args = CommandLine( )
+    def __init__( self, argv = None ):
+        self.args = CommandLine( argv )
         self.ini = SafeConfigParser( )
         self.ini.read( self.args.config )
         
@@ -134,11 +200,17 @@ class Configuration:
         self.ignore_words= self.as_array( "IgnoreWords" )
     
         self.zip_program = self.get_property( "ArchiveProgram" )
+        self.low_priority_io = self.as_boolean( "LowPriorityIO" )
+        self.archive_backend = self.get_property( "ArchiveBackend", "auto" ).lower( )
         self.media_sandbox = self.as_array( "MediaSandbox" )
         self.sandbox_password = self.get_property( "SandboxPassword" )
+        self.sandbox_pattern = re.compile( '|'.join( fnmatch.translate( p if re.search( r'[*?[]', p ) else '*{}*'.format( p ) )
+                                                     for p in self.media_sandbox ),
+                                           re.IGNORECASE ) if self.media_sandbox else None
 
         self.stacked_flag = self.as_boolean( "FlattenStacked" )
         self.re_stacked = self.get_property( "StackedRegex" )
+        self.stacked_pattern = re.compile( self.re_stacked, re.IGNORECASE ) if self.stacked_flag else None
         
         self.parent_flag = self.as_boolean( "MakeParent" )
         self.re_parent = self.get_property( "ParentRegex" )
@@ -156,12 +228,22 @@ class Configuration:
                 raise ValueError( 'Bad format for {}. Expecting <remote path> <local path>.'.format( map_property ) )
             self.storage_map = map_tuple[0], map_tuple[1]
 
+        self.storage_folder = None
+
+        bandwidth_default = os.path.join( tempfile.gettempdir( ), 'postprocess-bandwidth.json' )
+        self.copy_limiter = RateLimiter( Schedule( self.get_property( "CopyRate" ), self.get_property( "CopySchedule" ) ),
+                                         Schedule( self.get_property( "GlobalCopyRate" ), self.get_property( "GlobalCopySchedule" ) ),
+                                         self.get_property( "BandwidthState", bandwidth_default ) )
+
+    def select_storage_folder( self ):
+        ''' Return the Storage folder with the most free space. May query the StorageService.
+        '''
         storage = self.get_property( "Storage",  default = os.path.expanduser( '~\\Documents' ) )
         path_list = filter( lambda f: os.path.isdir( f ), glob.glob( storage ) )
         space_list = map( lambda p: Storage.GetFreeSpace( self.storage_service, self.storage_map, p ), path_list )
         largest = max( space_list )
         index = space_list.index( largest )
-        self.storage_folder = path_list[index]
+        return path_list[index]
         
     def get_property( self, name, default = None ):
         value = self._get_property( name, default )
@@ -193,11 +275,13 @@ class Storage:
         An example StorageService configuration is defined like this:
             [Movies]
             Storage = \\FileServer\MOVIES??
-            StorageService = http://FileServer/disks.json.php
+            StorageService = http://FileServer:8080/disks.json
             StorageMap = /share/MOVIES \\FileServer\MOVIES
         
-        A simple http GET is sent to the storage server to fetch JSON data at the StorageService URL. An example JSON
-        response captured from a "mount" system call is as follows (abbreviated to reduce display width):
+        A simple http GET is sent to the storage server (storaged.py) to fetch JSON data at the StorageService URL. The
+        request is conditional: the last good response is cached in the temp folder with its ETag and Last-Modified
+        validators, a 304 reply reuses it, and it is also used (with a warning) when the server cannot be reached. An
+        example JSON response is as follows (abbreviated to reduce display width):
         [
             ...
             { "size" : 19236, "used" : 16460, "available" : 79576, "mount" : "/share/MOVIES01" }
@@ -246,13 +330,60 @@ class Storage:
         ''' Get the storage objects from the remote server.
         '''
         if not Storage._storage_list:
-            response = urllib.urlopen( url )
-            json_data = json.load( response )
+            json_data = Storage.Fetch( url )
             storage_list = map( lambda jd: Storage( jd, storage_map ), json_data )
             storage_list = sorted( storage_list, cmp = lambda soa, sob: len( sob.mount ) - len( soa.mount ) )
             Storage._storage_list = storage_list
         return Storage._storage_list
 
+    @staticmethod
+    def Fetch( url ):
+        ''' Conditional GET of the StorageService JSON that falls back to the last good snapshot.
+        '''
+        cache = os.path.join( tempfile.gettempdir( ), 'postprocess-storage-{}.json'.format( hashlib.md5( url ).hexdigest( ) ) )
+        cached = None
+        try:
+            with open( cache ) as f:
+                cached = json.load( f )
+        except ( IOError, ValueError ):
+            pass
+
+        request = urllib2.Request( url )
+        if cached and cached.get( 'etag' ):
+            request.add_header( 'If-None-Match', cached[ 'etag' ] )
+        if cached and cached.get( 'modified' ):
+            request.add_header( 'If-Modified-Since', cached[ 'modified' ] )
+        try:
+            response = urllib2.urlopen( request, timeout = 30 )
+            json_data = json.load( response )
+        except urllib2.HTTPError as e:
+            if e.code == 304 and cached:
+                logging.debug( "Storage metadata from {} not modified.".format( url ) )
+                return cached[ 'data' ]
+            if not cached:
+                raise
+            logging.warn( "Unable to fetch storage metadata from {} ({}). Using snapshot from {}.".format( url, e, cached[ 'fetched' ] ) )
+            return cached[ 'data' ]
+        except ( IOError, ValueError ) as e:
+            if not cached:
+                raise
+            logging.warn( "Unable to fetch storage metadata from {} ({}). Using snapshot from {}.".format( url, e, cached[ 'fetched' ] ) )
+            return cached[ 'data' ]
+
+        try:
+            temporary = '{}.{}'.format( cache, os.getpid( ) )
+            with open( temporary, 'w' ) as f:
+                json.dump( { 'etag' : response.info( ).getheader( 'ETag' ),
+                             'modified' : response.info( ).getheader( 'Last-Modified' ),
+                             'fetched' : time.strftime( '%Y-%m-%dT%H:%M:%S' ),
+                             'data' : json_data }, f )
+            if os.path.exists( cache ):
+                os.remove( cache )
+            os.rename( temporary, cache )
+        except ( IOError, OSError ) as e:
+            logging.warn( "Unable to cache storage metadata in {}: {}".format( cache, e ) )
+        return json_data
+
     @staticmethod
     def GetFreeStorageSpace( storage_service, storage_map, path ):
         ''' Return the free space available for the given path from the remote storage server. Relies on the remote
@@ -266,8 +397,9 @@ class Storage:
     @staticmethod
     def GetFreeSpace( storage_service, storage_map, path ):
         try:
-            return Storage.GetFreeDiskSpaceEx( path ) if not storage_service else \
-                   Storage.GetFreeStorageSpace( storage_service, storage_map, path )
+            with trace.span( 'storage', path ):
+                return Storage.GetFreeDiskSpaceEx( path ) if not storage_service else \
+                       Storage.GetFreeStorageSpace( storage_service, storage_map, path )
         except:
             logging.error( "Unable to fetch storage metadata from {}. Skipping.".format( storage_service ) )
 
@@ -296,63 +428,529 @@ class Context:
             setattr( self, groupname, match.group( groupname ) )
 
 
+def cached_kilobytes( ):
+    ''' Size of the page cache in KiB from /proc/meminfo, or None where that is not available.
+    '''
+    try:
+        with open( '/proc/meminfo' ) as f:
+            for line in f:
+                if line.startswith( 'Cached:' ):
+                    return int( line.split( )[1] )
+    except ( IOError, ValueError, IndexError ):
+        pass
+    return None
+
+
+class Trace:
+    ''' Timed spans and counters for a single run. Each span is charged to a phase (scan, probe, test, extract,
+        sandbox, storage, copy); the report keeps the total time per phase and only the slowest few spans so that its
+        size does not grow with the number of files in the pack. Phase times are inclusive, so sandbox time is also
+        counted in extract. The size of the page cache is recorded at the start and end of the run.
+    '''
+    PHASES = [ 'scan', 'probe', 'test', 'extract', 'sandbox', 'storage', 'copy' ]
+    COUNTERS = [ 'subprocesses', 'bytes_read', 'bytes_written', 'files_copied', 'bytes_copied', 'files_skipped',
+                 'throttled_seconds' ]
+
+    def __init__( self, slowest = 10 ):
+        self.started = time.time( )
+        self.slowest = slowest
+        self.phases = OrderedDict( ( phase, { 'spans' : 0, 'seconds' : 0.0, 'slowest' : [ ] } ) for phase in self.PHASES )
+        self.counters = OrderedDict( ( counter, 0 ) for counter in self.COUNTERS )
+        self.page_cache = OrderedDict( [ ( 'before', cached_kilobytes( ) ), ( 'after', None ) ] )
+
+    @contextlib.contextmanager
+    def span( self, phase, target = None ):
+        start = time.time( )
+        try:
+            yield
+        finally:
+            self.add( phase, target, time.time( ) - start )
+
+    def add( self, phase, target, seconds ):
+        entry = self.phases[ phase ]
+        entry[ 'spans' ] += 1
+        entry[ 'seconds' ] += seconds
+        slowest = entry[ 'slowest' ]
+        if len( slowest ) < self.slowest or seconds > slowest[-1][ 'seconds' ]:
+            slowest.append( { 'target' : target, 'seconds' : seconds } )
+            slowest.sort( key = lambda s: s[ 'seconds' ], reverse = True )
+            del slowest[ self.slowest: ]
+
+    def count( self, counter, value = 1 ):
+        self.counters[ counter ] += value
+
+    def report( self, args, error = None ):
+        return OrderedDict( [
+            ( 'infohash', args.infohash ),
+            ( 'label', args.label ),
+            ( 'title', args.title ),
+            ( 'directory', args.directory ),
+            ( 'file', args.file ),
+            ( 'started', time.strftime( '%Y-%m-%dT%H:%M:%S', time.localtime( self.started ) ) ),
+            ( 'wall', time.time( ) - self.started ),
+            ( 'error', repr( error ) if error else None ),
+            ( 'counters', self.counters ),
+            ( 'page_cache_kb', self.page_cache ),
+            ( 'phases', self.phases ) ] )
+
+    def write( self, args, error = None, profiler = None ):
+        ''' Log a one line summary per phase and save the report (and profile statistics) into the report folder. The
+            file name is keyed by label and infohash so a repeated run of the same torrent replaces its last report.
+        '''
+        self.page_cache[ 'after' ] = cached_kilobytes( )
+        report = self.report( args, error )
+        for phase, entry in self.phases.items( ):
+            if entry[ 'spans' ]:
+                logging.info( "Phase {} took {:.3f}s over {} spans".format( phase, entry[ 'seconds' ], entry[ 'spans' ] ) )
+        logging.info( "Run took {:.3f}s {}".format( report[ 'wall' ], ' '.join( '{}={}'.format( *c ) for c in self.counters.items( ) ) ) )
+        if self.page_cache[ 'before' ] is not None and self.page_cache[ 'after' ] is not None:
+            logging.info( "Page cache {} KiB before, {} KiB after ({:+} KiB)".format(
+                self.page_cache[ 'before' ], self.page_cache[ 'after' ], self.page_cache[ 'after' ] - self.page_cache[ 'before' ] ) )
+        if not args.report:
+            return
+        key = '-'.join( [ args.label or 'Default', args.infohash or time.strftime( '%Y%m%d%H%M%S', time.localtime( self.started ) ) ] )
+        basename = os.path.join( args.report, re.sub( r'[^\w.-]+', '_', key ) )
+        try:
+            if not os.path.isdir( args.report ):
+                os.makedirs( args.report )
+            with open( basename + '.json', 'w' ) as f:
+                json.dump( report, f, indent = 2 )
+            if profiler:
+                profiler.dump_stats( basename + '.prof' )
+        except ( IOError, OSError ) as e:
+            logging.error( "Unable to write run report {}: {}".format( basename, e ) )
+        if profiler:
+            stream = StringIO( )
+            pstats.Stats( profiler, stream = stream ).sort_stats( 'cumulative' ).print_stats( 25 )
+            logging.debug( stream.getvalue( ) )
+
+
+FS_ENCODING = sys.getfilesystemencoding( ) or 'utf-8'
+
+def fs_unicode( path ):
+    ''' Decode a file system path so that paths from the command line, os.walk and JSON compare equal.
+    '''
+    if path is None or isinstance( path, unicode ):
+        return path
+    try:
+        return path.decode( FS_ENCODING )
+    except UnicodeDecodeError:
+        return path.decode( 'utf-8', 'replace' )
+
+def fs_bytes( path ):
+    ''' Inverse of fs_unicode, for paths read back from JSON.
+    '''
+    if path is None or not isinstance( path, unicode ):
+        return path
+    try:
+        return path.encode( FS_ENCODING )
+    except UnicodeEncodeError:
+        return path.encode( 'utf-8' )
+
+
+class Manifest:
+    ''' Record of a completed run for one infohash: the storage folder used, the size and modification time of every
+        source file, and the files copied to storage. uTorrent runs the completion program again after a recheck, a
+        move or a label change; the manifest lets such a run finish without touching the archive program or the
+        storage server when nothing changed, and limits it to new or changed files otherwise.
+
+        Paths outside the source (e.g. extraction workspaces) are always treated as changed since they only exist
+        because their archive changed. File keys are relative to the source, so a torrent moved to another folder
+        keeps its manifest and only the recorded source is updated. Paths kept in the manifest (source, file keys, copied) are unicode, as json
+        returns them; storage is handed back as a file system string.
+    '''
+    def __init__( self, filename, source ):
+        self.filename = filename
+        self.source = fs_unicode( source )
+        source = fs_bytes( source )
+        self.root = source if os.path.isdir( source ) else os.path.dirname( source )
+        self.current = self.snapshot( source )
+        self.previous = { }
+        self.storage = None
+        self.copied = [ ]
+        self.moved = False
+        if os.path.isfile( filename ):
+            try:
+                with open( filename ) as f:
+                    data = json.load( f )
+                if data.get( 'source' ) != self.source:
+                    self.moved = True
+                    logging.info( "Torrent moved from {} to {}".format( fs_bytes( data.get( 'source' ) ), source ) )
+                self.previous = dict( ( k, tuple( v ) ) for k, v in data.get( 'files', { } ).items( ) )
+                self.storage = fs_bytes( data.get( 'storage' ) )
+                self.copied = data.get( 'copied', [ ] )
+            except ( IOError, ValueError ) as e:
+                logging.warn( "Ignoring unreadable manifest {}: {}".format( filename, e ) )
+        self.changed_set = set( k for k, v in self.current.items( ) if self.previous.get( k ) != v )
+
+    @staticmethod
+    def Load( args ):
+        ''' Return the manifest for the infohash on the command line, or None if there is no infohash or manifests
+            are disabled.
+        '''
+        if not args.manifest or not args.infohash:
+            return None
+        filename = os.path.join( args.manifest, re.sub( r'[^\w.-]+', '_', args.infohash.upper( ) ) + '.json' )
+        source = os.path.join( args.directory, args.file ) if args.file else args.directory
+        return Manifest( filename, source )
+
+    def snapshot( self, source ):
+        ''' Map each regular file under source (relative path) to its ( size, mtime ).
+        '''
+        if os.path.isfile( source ):
+            stinfo = os.stat( source )
+            return { fs_unicode( os.path.basename( source ) ) : ( stinfo.st_size, stinfo.st_mtime ) }
+        files = { }
+        for folder, subfolders, names in os.walk( source ):  # @UnusedVariable
+            for name in names:
+                fullname = os.path.join( folder, name )
+                stinfo = os.stat( fullname )
+                files[ fs_unicode( os.path.relpath( fullname, source ) ) ] = ( stinfo.st_size, stinfo.st_mtime )
+        return files
+
+    def unchanged( self ):
+        ''' True if a previous run completed and no source file was added, removed or modified since.
+        '''
+        return self.storage is not None and self.previous == self.current and os.path.isdir( self.storage )
+
+    def relative( self, fullname ):
+        relname = os.path.relpath( fs_bytes( fullname ), self.root )
+        return None if relname.startswith( os.pardir ) else fs_unicode( relname )
+
+    def changed( self, fullname ):
+        relname = self.relative( fullname )
+        return relname is None or relname in self.changed_set
+
+    def replaces( self, storage_fullname ):
+        ''' True if storage_fullname was copied by a previous run. handle_media is only called for new or changed
+            source files, so such a copy is stale and is overwritten; files that were already in storage before the
+            first run are never touched.
+        '''
+        return fs_unicode( storage_fullname ) in self.copied
+
+    def archive_changed( self, archive ):
+        ''' True if the archive or any volume of its fileset is new or changed.
+        '''
+        if self.changed( archive ):
+            return True
+        folder = os.path.dirname( archive )
+        return any( fileset_filter( archive, fullname ) for fullname in
+                    ( os.path.join( self.root, fs_bytes( relname ) ) for relname in self.changed_set )
+                    if os.path.dirname( fullname ) == folder )
+
+    def filter( self, folder ):
+        ''' Drop unchanged files from the folder buckets.
+        '''
+        for bucket, test in [ ( 'archive', self.archive_changed ), ( 'media', self.changed ), ( 'other', self.changed ),
+                              ( 'subtitle', self.changed ), ( 'meta', self.changed ) ]:
+            file_list = getattr( folder, bucket )
+            kept = filter( test, file_list )
+            trace.count( 'files_skipped', len( file_list ) - len( kept ) )
+            setattr( folder, bucket, kept )
+        return folder
+
+    def save( self, storage ):
+        data = OrderedDict( [
+            ( 'infohash', config.args.infohash ),
+            ( 'label', config.args.label ),
+            ( 'source', self.source ),
+            ( 'storage', fs_unicode( storage ) ),
+            ( 'completed', time.strftime( '%Y-%m-%dT%H:%M:%S' ) ),
+            ( 'files', self.current ),
+            ( 'copied', sorted( set( self.copied ) ) ) ] )
+        folder = os.path.dirname( self.filename )
+        try:
+            if not os.path.isdir( folder ):
+                os.makedirs( folder )
+            temporary = self.filename + '.tmp'
+            with open( temporary, 'w' ) as f:
+                json.dump( data, f, indent = 2 )
+            if os.path.exists( self.filename ):
+                os.remove( self.filename )
+            os.rename( temporary, self.filename )
+        except ( IOError, OSError ) as e:
+            logging.error( "Unable to write manifest {}: {}".format( self.filename, e ) )
+
+
+def parse_rate( value ):
+    ''' Bytes per second from a rate such as 512K, 20M or 1.5G (binary multiples). Empty or "unlimited" is None and 0
+        pauses copying.
+    '''
+    value = ( value or '' ).strip( ).lower( )
+    if value in [ '', 'unlimited', 'none', '-' ]:
+        return None
+    match = re.match( r'^(\d+(?:\.\d+)?)\s*([kmg]?)b?$', value )
+    if not match:
+        raise ValueError( 'Bad rate {}. Expecting a number with an optional K, M or G suffix.'.format( value ) )
+    return int( float( match.group( 1 ) ) * { '' : 1, 'k' : 1 << 10, 'm' : 1 << 20, 'g' : 1 << 30 }[ match.group( 2 ) ] )
+
+
+class Schedule:
+    ''' Rate that depends on the time of day, like the uTorrent scheduler. The schedule is a comma separated list of
+            [<day>[-<day>]] <HH:MM>-<HH:MM> <rate>
+        where the days are mon..sun and the rate is as for parse_rate. The first entry matching the local time wins;
+        otherwise the default rate applies. A time range may wrap past midnight (23:00-07:00); the day refers to the
+        day the current time falls on.
+    '''
+    DAYS = [ 'mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun' ]
+    ENTRY = re.compile( r'^(?:(?P<first>[a-z]{3})(?:-(?P<last>[a-z]{3}))?\s+)?'
+                        r'(?P<start>\d{1,2}):(?P<start_minute>\d{2})-(?P<end>\d{1,2}):(?P<end_minute>\d{2})\s+(?P<rate>\S+)$' )
+
+    def __init__( self, default = None, schedule = None ):
+        self.default = parse_rate( default )
+        self.entries = [ ]
+        for entry in ( schedule or '' ).split( ',' ):
+            entry = entry.strip( ).lower( )
+            if not entry:
+                continue
+            match = self.ENTRY.match( entry )
+            if not match or any( day and day not in self.DAYS for day in match.group( 'first', 'last' ) ):
+                raise ValueError( 'Bad schedule entry {}. Expecting [<day>[-<day>]] <HH:MM>-<HH:MM> <rate>.'.format( entry ) )
+            first = self.DAYS.index( match.group( 'first' ) ) if match.group( 'first' ) else 0
+            last = self.DAYS.index( match.group( 'last' ) ) if match.group( 'last' ) else first if match.group( 'first' ) else 6
+            days = set( ( first + i ) % 7 for i in range( ( last - first ) % 7 + 1 ) )
+            hours = int( match.group( 'start' ) ), int( match.group( 'end' ) )
+            minutes = int( match.group( 'start_minute' ) ), int( match.group( 'end_minute' ) )
+            if max( hours ) > 23 or max( minutes ) > 59:
+                raise ValueError( 'Bad schedule entry {}. Hours must be 0-23 and minutes 0-59.'.format( entry ) )
+            start = hours[0] * 60 + minutes[0]
+            end = hours[1] * 60 + minutes[1]
+            self.entries.append( ( days, start, end, parse_rate( match.group( 'rate' ) ) ) )
+
+    def limited( self ):
+        return self.default is not None or any( rate is not None for days, start, end, rate in self.entries )  # @UnusedVariable
+
+    def rate( self, now = None ):
+        local = time.localtime( now )
+        minute = local.tm_hour * 60 + local.tm_min
+        for days, start, end, rate in self.entries:
+            if local.tm_wday not in days:
+                continue
+            if start <= minute < end if start <= end else minute >= start or minute < end:
+                return rate
+        return self.default
+
+
+class TokenBucket:
+    ''' Token bucket holding at most BURST seconds worth of bytes. reserve() always takes the tokens, letting the
+        bucket go negative, and returns how long the caller has to wait before using them.
+    '''
+    BURST = 1.0
+
+    def __init__( self ):
+        self.tokens = None
+        self.updated = None
+
+    def reserve( self, rate, amount ):
+        now = time.time( )
+        if self.tokens is None:
+            self.tokens = rate * self.BURST
+        else:
+            self.tokens = min( rate * self.BURST, self.tokens + max( 0.0, now - self.updated ) * rate )
+        self.updated = now
+        self.tokens -= amount
+        return max( 0.0, -self.tokens / rate )
+
+
+class SharedTokenBucket( TokenBucket ):
+    ''' Token bucket kept in a small JSON file so that every postprocess on the host draws from the same bucket. The
+        file is locked for the read-modify-write of each reservation.
+    '''
+    def __init__( self, filename ):
+        TokenBucket.__init__( self )
+        self.filename = filename
+
+    def reserve( self, rate, amount ):
+        with os.fdopen( os.open( self.filename, os.O_RDWR | os.O_CREAT, 0o666 ), 'r+' ) as f:
+            lock_file( f )
+            try:
+                f.seek( 0 )
+                try:
+                    state = json.load( f )
+                    self.tokens, self.updated = float( state[ 'tokens' ] ), float( state[ 'updated' ] )
+                except ( ValueError, KeyError, TypeError ):
+                    self.tokens = self.updated = None
+                wait = TokenBucket.reserve( self, rate, amount )
+                f.seek( 0 )
+                f.truncate( )
+                json.dump( { 'tokens' : self.tokens, 'updated' : self.updated }, f )
+                f.flush( )
+            finally:
+                unlock_file( f )
+        return wait
+
+
+class RateLimiter:
+    ''' Throttle the copy path with a token bucket for this process (CopyRate/CopySchedule) and one shared by every
+        postprocess on the host (GlobalCopyRate/GlobalCopySchedule). A scheduled rate of 0 pauses copying until the
+        schedule allows it again.
+    '''
+    PAUSE_POLL = 60
+
+    def __init__( self, local, shared, filename ):
+        self.local = local
+        self.shared = shared
+        self.bucket = TokenBucket( )
+        self.shared_bucket = SharedTokenBucket( filename )
+
+    def active( self ):
+        return self.local.limited( ) or self.shared.limited( )
+
+    def throttle( self, amount ):
+        waited = 0.0
+        local, shared = self.local.rate( ), self.shared.rate( )
+        if local == 0 or shared == 0:
+            logging.info( "Copying paused by schedule." )
+            while local == 0 or shared == 0:
+                time.sleep( self.PAUSE_POLL )
+                waited += self.PAUSE_POLL
+                local, shared = self.local.rate( ), self.shared.rate( )
+            logging.info( "Copying resumed after {:.0f}s.".format( waited ) )
+        wait = 0.0
+        if local:
+            wait = self.bucket.reserve( local, amount )
+        if shared:
+            try:
+                wait = max( wait, self.shared_bucket.reserve( shared, amount ) )
+            except ( IOError, OSError ) as e:
+                logging.warn( "Unable to use the shared bandwidth state {}: {}".format( self.shared_bucket.filename, e ) )
+        if wait:
+            time.sleep( wait )
+        trace.count( 'throttled_seconds', waited + wait )
+
+
+CHUNK_SIZE = 1 << 20
+WRITEBACK_SIZE = 8 * CHUNK_SIZE
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_DONTNEED = 4
+
+def popen( cmd, **kwargs ):
+    ''' subprocess.Popen that counts the processes launched during the run.
+    '''
+    trace.count( 'subprocesses' )
+    return subprocess.Popen( cmd, shell = False, **kwargs )
+
+def idle_io( ):
+    ''' Move this process into the idle I/O scheduling class (ionice -c 3) so that in-process extraction and copies
+        only get the disk when nothing else wants it. ArchiveProgram children inherit the class.
+    '''
+    if not ionice:
+        return
+    if popen( [ ionice, '-c', '3', '-p', str( os.getpid( ) ) ] ).wait( ):
+        logging.warn( "Unable to set the idle I/O scheduling class." )
+
 def commandline( cmd, pattern_list = [ ] ):
     ''' Execute cmd then pass output through regex. Named regex match groups are added to the context object as
         attributes.
     '''
     context = Context( name = cmd[0] )
-    p = subprocess.Popen( cmd, shell = False, stdout = subprocess.PIPE, stderr = subprocess.STDOUT )
+    p = popen( cmd, stdout = subprocess.PIPE, stderr = subprocess.STDOUT )
     for line in p.stdout.readlines( ):
         for pattern in pattern_list:
             context.search( pattern, line )
     context.return_code = p.wait( )
     return context
 
-def listdir( path ):
-    ''' Same as os.listdir but returns full path names. 
+class Entry:
+    ''' Minimal stand-in for os.DirEntry when neither os.scandir nor the scandir package is available. The entry is
+        stat'ed once, on first use, and both tests read the cached mode.
     '''
-    return map( lambda f: os.path.join( path, f ), os.listdir( path ) )
+    def __init__( self, folder, name ):
+        self.name = name
+        self.path = os.path.join( folder, name )
+        self._mode = None
 
-def extension_in_list( fullname, ext_list ):
-    ''' True if filename extension is in the supplied list of extensions.
-    '''
-    name, ext = os.path.splitext( fullname.lower( ) )  # @UnusedVariable
-    return ext in ext_list
+    def mode( self ):
+        if self._mode is None:
+            try:
+                self._mode = os.stat( self.path ).st_mode
+            except OSError:
+                self._mode = 0
+        return self._mode
 
-def ignored( fullname ):
-    ''' True if the filename contains an ignored sub-string. 
-    '''
-    return any( word in os.path.basename( fullname.lower( ) ) for word in config.ignore_words )
+    def is_file( self ):
+        return stat.S_ISREG( self.mode( ) )
 
-def ignore_filter( fullname ):
-    ''' True if path is a regular file and does not contain an ignored sub-string.
-    '''
-    return os.path.isfile( fullname ) and not ignored( fullname )
+    def is_dir( self ):
+        return stat.S_ISDIR( self.mode( ) )
 
-def media_filter( fullname ):
-    ''' True if media file has a media extension, or if wild-card '*' is specified; then will include any extension not
-        already defined as meta, subtitle, or archive.
-    '''
-    return extension_in_list( fullname, config.media_extensions ) if config.media_extensions != ['*'] else \
-           not extension_in_list( fullname, itertools.chain( config.meta_extensions, \
-                                                             config.subtitle_extensions, \
-                                                             config.archive_extensions ) )
 
-def meta_filter( fullname ):
-    ''' True if full-name has a meta-file extension.  
+class Folder:
+    ''' Directory entries sorted into buckets by a single scan of the source folder. Each bucket is a list of full
+        path names.
     '''
-    return extension_in_list( fullname, config.meta_extensions ) 
+    def __init__( self, path ):
+        self.path = path
+        self.media = [ ]
+        self.subtitle = [ ]
+        self.meta = [ ]
+        self.archive = [ ]
+        self.other = [ ]
+        self.ignored = [ ]
+        self.folders = [ ]
 
-def subtitle_filter( fullname ):
-    ''' '' True if full-name has a subtitle extension.
-    '''
-    return extension_in_list( fullname, config.subtitle_extensions )
 
-def archive_filter( fullname ):
-    ''' True if full-name has an archive extension and passes archive integrity check. The integrity check has the
-        added benefit of filtering out subordinate archive files in a multi-part fileset. 
+class Classifier:
+    ''' Classify directory entries into media, subtitle, meta, archive and ignored buckets. Extension lists are turned
+        into sets and the ignored words into a single regular expression once per run, so each entry is lowercased and
+        split exactly once.
+
+        Media extensions may be the wild-card '*'; then any extension not already defined as meta, subtitle, or archive
+        is treated as media. Otherwise files with an unknown extension go to 'other', which is copied like media.
+        Sandbox outputs are always media.
     '''
-    return extension_in_list( fullname, config.archive_extensions ) and archive_test( fullname )
+    def __init__( self, config ):
+        self.archive_extensions = frozenset( config.archive_extensions or [ ] )
+        self.subtitle_extensions = frozenset( config.subtitle_extensions or [ ] )
+        self.meta_extensions = frozenset( config.meta_extensions or [ ] )
+        self.media_wildcard = config.media_extensions == [ '*' ]
+        self.media_extensions = frozenset( config.media_extensions or [ ] ) if not self.media_wildcard else frozenset( )
+        words = filter( None, config.ignore_words or [ ] )
+        self.ignore_pattern = re.compile( '|'.join( map( re.escape, words ) ) ) if words else None
+
+    def ignored( self, name ):
+        ''' True if the lowercase file name contains an ignored sub-string.
+        '''
+        return self.ignore_pattern is not None and self.ignore_pattern.search( name ) is not None
+
+    def classify( self, name ):
+        ''' Return the name of the bucket the file name belongs to.
+        '''
+        lower_name = name.lower( )
+        if lower_name.endswith( Sandbox.SUFFIX ):
+            return 'media'
+        if self.ignored( lower_name ):
+            return 'ignored'
+        ext = os.path.splitext( lower_name )[1]
+        if ext in self.archive_extensions:
+            return 'archive'
+        elif ext in self.media_extensions:
+            return 'media'
+        elif ext in self.subtitle_extensions:
+            return 'subtitle'
+        elif ext in self.meta_extensions:
+            return 'meta'
+        elif self.media_wildcard:
+            return 'media'
+        return 'other'
+
+    def scan( self, path ):
+        ''' Read the directory once and return a Folder with every entry in its bucket. Archives are bucketed by
+            extension only; the integrity check is left to the caller because it launches the archive program.
+        '''
+        folder = Folder( path )
+        for entry in self.entries( path ):
+            if entry.is_dir( ):
+                folder.folders.append( entry.path )
+            elif entry.is_file( ):
+                getattr( folder, self.classify( entry.name ) ).append( entry.path )
+        return folder
+
+    @staticmethod
+    def entries( path ):
+        if scandir:
+            return scandir( path )
+        return ( Entry( path, name ) for name in os.listdir( path ) )
 
 def fileset_filter( archive, fullname ):
     ''' True is full-name is part of archive fileset (assume context has already been verified to have more than one
@@ -366,18 +964,422 @@ def fileset_filter( archive, fullname ):
            ( archive_basename == basename and ext[-1:].isdigit( ) ) or \
            ( archive_ext == ext and basename[-1:].isdigit( ) )
 
+def sandboxed( name ):
+    ''' True if the base name of an archive member matches one of the MediaSandbox patterns. A plain pattern (no
+        wildcards) matches anywhere in the name, so keygen.exe also catches Team.KeyGen.exe.
+    '''
+    return config.sandbox_pattern is not None and \
+           config.sandbox_pattern.match( os.path.basename( name.replace( '\\', '/' ) ) ) is not None
+
+def write_member( workspace, archive, name, mtime, stream, size = None ):
+    ''' Write an archive member from stream into the workspace. When size is given exactly that many bytes are read,
+        so a stream holding several members back to back stays aligned. Members that would land outside the
+        workspace are skipped.
+    '''
+    root = os.path.realpath( workspace )
+    fullname = os.path.realpath( os.path.join( root, name ) )
+    if not fullname.startswith( root + os.sep ):
+        logging.warn( "Skipping {} in {}: path is outside the workspace.".format( name, archive ) )
+        copy_stream( stream, None, size )
+        return
+    if not os.path.isdir( os.path.dirname( fullname ) ):
+        os.makedirs( os.path.dirname( fullname ) )
+    with open( fullname, 'wb' ) as f:
+        trace.count( 'bytes_written', copy_stream( stream, f, size ) )
+    if mtime is not None:
+        os.utime( fullname, ( mtime, mtime ) )
+
+def copy_stream( source, destination, size = None ):
+    ''' Copy size bytes (or everything when size is None) from source to destination, which may be None to discard
+        them. Returns the number of bytes copied. With LowPriorityIO the written pages are dropped from the page cache
+        every WRITEBACK_SIZE bytes, as copy_file does.
+    '''
+    drop = destination is not None and config.low_priority_io and posix_fadvise and hasattr( destination, 'fileno' )
+    copied = written = 0
+    while size is None or copied < size:
+        chunk = source.read( CHUNK_SIZE if size is None else min( CHUNK_SIZE, size - copied ) )
+        if not chunk:
+            break
+        if destination is not None:
+            destination.write( chunk )
+        copied += len( chunk )
+        if drop and copied - written >= WRITEBACK_SIZE:
+            drop_written( destination, written, copied - written )
+            written = copied
+    if drop and copied > written:
+        drop_written( destination, written, copied - written )
+    if size is not None and copied != size:
+        raise AssertionError( 'Unexpected end of archive stream', size, copied )
+    return copied
+
+
+def fadvise( f, offset, length, advice ):
+    error = posix_fadvise( f.fileno( ), offset, length, advice )
+    if error:
+        logging.debug( "posix_fadvise( {}, {}, {}, {} ) failed: {}".format( f.name, offset, length, advice, os.strerror( error ) ) )
+
+def drop_written( f, offset, length ):
+    ''' Write back a range of f and drop it from the page cache. Dirty pages cannot be dropped until they are on disk.
+    '''
+    f.flush( )
+    os.fdatasync( f.fileno( ) )
+    fadvise( f, offset, length, POSIX_FADV_DONTNEED )
+
+def copy_file( source, destination ):
+    ''' shutil.copy2, unless copies are rate limited or LowPriorityIO is set on Linux. Then the file is copied in
+        chunks; each chunk waits for the copy limiter, and with LowPriorityIO the pages of both files are dropped from
+        the page cache as the copy goes, so copying a large pack does not evict everything else the host has cached.
+        Source pages are dropped after every chunk; destination pages are written back and dropped every
+        WRITEBACK_SIZE bytes.
+    '''
+    drop = config.low_priority_io and posix_fadvise
+    limiter = config.copy_limiter if config.copy_limiter.active( ) else None
+    if not ( drop or limiter ):
+        shutil.copy2( source, destination )
+        return
+    with open( source, 'rb' ) as fsrc, open( destination, 'wb' ) as fdst:
+        if drop:
+            fadvise( fsrc, 0, 0, POSIX_FADV_SEQUENTIAL )
+        offset = written = 0
+        while True:
+            chunk = fsrc.read( CHUNK_SIZE )
+            if not chunk:
+                break
+            if limiter:
+                limiter.throttle( len( chunk ) )
+            fdst.write( chunk )
+            offset += len( chunk )
+            if drop:
+                fadvise( fsrc, offset - len( chunk ), len( chunk ), POSIX_FADV_DONTNEED )
+                if offset - written >= WRITEBACK_SIZE:
+                    drop_written( fdst, written, offset - written )
+                    written = offset
+        if drop:
+            drop_written( fdst, written, offset - written )
+    shutil.copystat( source, destination )
+
+
+class Sandbox:
+    ''' Password protected self-extracting archive that receives every sandboxed member of one archive. Members are
+        written into a tar stream piped to the ArchiveProgram's stdin, so the uncompressed files are never exposed to
+        the operating system (where a virus scanner may decide to quarantine them). The SFX can later be uncompressed
+        and evaluated using a sandbox environment built for the task; it holds a single <archive>.sandbox.tar.
+
+        The ArchiveProgram is only started when the first member is added.
+    '''
+    SUFFIX = '.sandbox.7z.exe'
+
+    def __init__( self, workspace, archive ):
+        basename = os.path.basename( archive )
+        self.tarname = basename + '.sandbox.tar'
+        self.filename = os.path.join( workspace, basename + self.SUFFIX )
+        self.encode = None
+        self.tar = None
+
+    def add( self, name, size, mtime, stream ):
+        with trace.span( 'sandbox', name ):
+            if not self.encode:
+                password = '-p{}'.format( config.sandbox_password )
+                self.encode = popen( [ config.zip_program, 'a', '-bd', '-y', '-si{}'.format( self.tarname ),
+                                       '-sfx7z.sfx', password, self.filename ],
+                                     stdin = subprocess.PIPE, stdout = subprocess.PIPE )
+                self.tar = tarfile.open( fileobj = self.encode.stdin, mode = 'w|' )
+            if size is None:
+                stream = StringIO( stream.read( ) )
+                size = len( stream.getvalue( ) )
+            info = tarfile.TarInfo( name.replace( '\\', '/' ) )
+            info.size = size
+            info.mtime = mtime or time.time( )
+            self.tar.addfile( info, stream )
+
+    def close( self ):
+        if not self.encode:
+            return
+        with trace.span( 'sandbox', self.filename ):
+            self.tar.close( )
+            self.encode.communicate( )
+        if self.encode.returncode:
+            raise AssertionError( 'Error sandboxing files', self.filename )
+
+
+class ExternalArchive:
+    ''' Archive operations performed by forking the ArchiveProgram (7-Zip). Handles every format, including RAR, 7z and
+        multi-volume filesets.
+    '''
+    def handles( self, archive ):  # @UnusedVariable
+        return True
+
+    def test( self, archive ):
+        context = commandline( [ config.zip_program, 't', '-bd', '-y', archive ] )
+        return context.return_code == 0
+
+    def context( self, archive ):
+        ''' Parse the technical listing (-slt). Archive properties come first, then one "Key = Value" block per member
+            after a line of dashes. Members are kept in archive order as ( path, size, mtime ) for regular files; size
+            is None if the format does not report it.
+        '''
+        context = Context( name = archive )
+        context.entries = [ ]
+        p = popen( [ config.zip_program, 'l', '-slt', '-bd', '-y', archive ], stdout = subprocess.PIPE,
+                   stderr = subprocess.STDOUT )
+        block = None
+        for line in p.stdout:
+            line = line.rstrip( '\r\n' )
+            if line.startswith( '----------' ):
+                block = { }
+            elif block is None:
+                context.search( 'Volumes = (?P<volumes>\d+)', line )
+            elif not line:
+                self.add_entry( context, block )
+                block = { }
+            elif ' = ' in line:
+                key, value = line.split( ' = ', 1 )
+                block[ key ] = value
+        if block:
+            self.add_entry( context, block )
+        context.return_code = p.wait( )
+        sandbox = filter( sandboxed, ( path for path, size, mtime in context.entries ) )  # @UnusedVariable
+        if sandbox:
+            context.sandbox = sandbox
+        return context
+
+    @staticmethod
+    def add_entry( context, block ):
+        if 'Path' not in block or block.get( 'Folder' ) == '+' or block.get( 'Attributes', '' ).startswith( 'D' ):
+            return
+        size = int( block[ 'Size' ] ) if block.get( 'Size', '' ).isdigit( ) else None
+        try:
+            mtime = time.mktime( time.strptime( block.get( 'Modified', '' )[:19], '%Y-%m-%d %H:%M:%S' ) )
+        except ValueError:
+            mtime = None
+        context.entries.append( ( block[ 'Path' ], size, mtime ) )
+
+    def extract( self, context, workspace, archive ):
+        ''' Without sandboxed members let the ArchiveProgram write everything. Otherwise decompress the whole archive
+            once to stdout (-so writes members back to back in archive order) and split the stream by member size:
+            sandboxed members go to the Sandbox, the rest are written to the workspace.
+        '''
+        sandbox_list = getattr( context, 'sandbox', None )
+        entries = getattr( context, 'entries', [ ] )
+        if not sandbox_list:
+            cmd = [ config.zip_program, 'x', '-bd', '-y', '-o{}'.format( workspace ), archive ]
+            result = commandline( cmd, [ '^Size:\s+(?P<size>\d+)' ] )
+            trace.count( 'bytes_written', result.getNumber( 'size' ) )
+            if result.return_code:
+                raise AssertionError( 'Error extracting files', workspace, archive )
+        elif any( size is None for path, size, mtime in entries ):  # @UnusedVariable
+            self.extract_twice( sandbox_list, entries, workspace, archive )
+        else:
+            self.extract_once( sandbox_list, entries, workspace, archive )
+
+    def extract_once( self, sandbox_list, entries, workspace, archive ):
+        sandbox_set = set( sandbox_list )
+        sandbox = Sandbox( workspace, archive )
+        xtract = popen( [ config.zip_program, 'x', '-bd', '-y', '-so', archive ], stdout = subprocess.PIPE )
+        try:
+            for path, size, mtime in entries:
+                if path in sandbox_set:
+                    sandbox.add( path, size, mtime, xtract.stdout )
+                else:
+                    write_member( workspace, archive, path, mtime, xtract.stdout, size )
+            if xtract.stdout.read( 1 ):
+                raise AssertionError( 'Archive stream is longer than its listing', archive )
+            sandbox.close( )
+        finally:
+            xtract.stdout.close( )
+            return_code = xtract.wait( )
+        if return_code:
+            raise AssertionError( 'Error extracting files', workspace, archive )
+
+    def extract_twice( self, sandbox_list, entries, workspace, archive ):
+        ''' Fallback for formats whose listing has no member sizes, so the -so stream cannot be split. Sandboxed
+            members (expected to be small) are read into memory one at a time, then everything else is extracted with
+            the sandboxed members excluded.
+        '''
+        mtimes = dict( ( path, mtime ) for path, size, mtime in entries )  # @UnusedVariable
+        sandbox = Sandbox( workspace, archive )
+        for path in sandbox_list:
+            xtract = popen( [ config.zip_program, 'x', '-bd', '-y', '-i!{}'.format( path ), '-so', archive ],
+                            stdout = subprocess.PIPE )
+            data = xtract.communicate( )[0]
+            if xtract.returncode:
+                raise AssertionError( 'Error extracting file', path )
+            sandbox.add( path, len( data ), mtimes.get( path ), StringIO( data ) )
+        sandbox.close( )
+        cmd = [ config.zip_program, 'x', '-bd', '-y' ] + [ '-x!{}'.format( path ) for path in sandbox_list ]
+        result = commandline( cmd + [ '-o{}'.format( workspace ), archive ], [ '^Size:\s+(?P<size>\d+)' ] )
+        trace.count( 'bytes_written', result.getNumber( 'size' ) )
+        if result.return_code:
+            raise AssertionError( 'Error extracting files', workspace, archive )
+
+
+class InternalArchive:
+    ''' Archive operations performed in-process with the standard library for zip, tar (optionally gzip or bzip2
+        compressed) and bare gz/bz2 files. Members are streamed to disk so nothing is held in memory, which avoids a
+        process launch and output parsing for every small archive in a pack. Sandboxed members still need the
+        ArchiveProgram to build the encrypted SFX; their data is streamed to it on stdin.
+
+        The context has the same attributes as the ArchiveProgram listing: volumes is left unset since only single
+        volume archives are handled here, and sandbox lists the members matching MediaSandbox.
+    '''
+    EXTENSIONS = frozenset( [ '.zip', '.tar', '.tgz', '.tbz', '.tbz2', '.gz', '.bz', '.bz2' ] )
+
+    def __init__( self ):
+        self._formats = { }
+
+    def format( self, archive ):
+        ''' Return 'zip', 'tar', 'gz' or 'bz2' if the archive can be handled in-process, otherwise None. Split zip
+            filesets (.z01, ...) and zips with an entry that is encrypted or neither stored nor deflated (Deflate64,
+            bzip2, LZMA, ...) are left to the ArchiveProgram.
+        '''
+        if archive not in self._formats:
+            self._formats[ archive ] = self._format( archive )
+        return self._formats[ archive ]
+
+    def _format( self, archive ):
+        name, ext = os.path.splitext( archive )
+        if ext.lower( ) not in self.EXTENSIONS:
+            return None
+        try:
+            if zipfile.is_zipfile( archive ):
+                if os.path.exists( name + '.z01' ) or os.path.exists( name + '.Z01' ):
+                    return None
+                with contextlib.closing( zipfile.ZipFile( archive ) ) as z:
+                    if any( info.compress_type not in ( zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED ) or info.flag_bits & 0x1
+                            for info in z.infolist( ) ):
+                        return None
+                return 'zip'
+            if tarfile.is_tarfile( archive ):
+                return 'tar'
+            with open( archive, 'rb' ) as f:
+                magic = f.read( 3 )
+        except ( IOError, OSError, zipfile.BadZipfile, zipfile.LargeZipFile ):
+            return None
+        if magic[:2] == '\x1f\x8b':
+            return 'gz'
+        if magic == 'BZh':
+            return 'bz2'
+        return None
+
+    def handles( self, archive ):
+        return self.format( archive ) is not None
+
+    def reject( self, archive ):
+        ''' Leave the archive to the ArchiveProgram for the rest of the run.
+        '''
+        self._formats[ archive ] = None
+
+    def members( self, archive ):
+        ''' Yield ( name, size, mtime, stream ) for each regular file in the archive. Size is None for bare gz/bz2
+            files. Each stream must be consumed before the next member is requested.
+        '''
+        kind = self.format( archive )
+        if kind == 'zip':
+            with contextlib.closing( zipfile.ZipFile( archive ) ) as z:
+                for info in z.infolist( ):
+                    if info.filename.endswith( '/' ):
+                        continue
+                    mtime = time.mktime( info.date_time + ( 0, 0, -1 ) )
+                    with contextlib.closing( z.open( info ) ) as stream:
+                        yield fs_bytes( info.filename ), info.file_size, mtime, stream
+        elif kind == 'tar':
+            with contextlib.closing( tarfile.open( archive, 'r|*' ) ) as t:
+                for info in t:
+                    if info.isfile( ):
+                        yield info.name, info.size, info.mtime, t.extractfile( info )
+        else:
+            opener = gzip.open if kind == 'gz' else bz2.BZ2File
+            name = os.path.splitext( os.path.basename( archive ) )[0]
+            with contextlib.closing( opener( archive, 'rb' ) ) as stream:
+                yield name, None, os.path.getmtime( archive ), stream
+
+    def names( self, archive ):
+        kind = self.format( archive )
+        if kind == 'zip':
+            with contextlib.closing( zipfile.ZipFile( archive ) ) as z:
+                return [ fs_bytes( name ) for name in z.namelist( ) if not name.endswith( '/' ) ]
+        elif kind == 'tar':
+            with contextlib.closing( tarfile.open( archive, 'r:*' ) ) as t:
+                return [ info.name for info in t.getmembers( ) if info.isfile( ) ]
+        return [ os.path.splitext( os.path.basename( archive ) )[0] ]
+
+    def test( self, archive ):
+        try:
+            for name, size, mtime, stream in self.members( archive ):  # @UnusedVariable
+                while stream.read( CHUNK_SIZE ):
+                    pass
+            return True
+        except Exception as e:
+            logging.warn( "Archive test failed for {}: {}".format( archive, e ) )
+            return False
+
+    def context( self, archive ):
+        context = Context( name = archive )
+        try:
+            sandbox = filter( sandboxed, self.names( archive ) )
+            if sandbox:
+                context.sandbox = sandbox
+            context.return_code = 0
+        except Exception as e:
+            logging.warn( "Unable to list {}: {}".format( archive, e ) )
+            context.return_code = 2
+        return context
+
+    def extract( self, context, workspace, archive ):
+        sandbox_set = set( getattr( context, 'sandbox', [ ] ) )
+        sandbox = Sandbox( workspace, archive )
+        try:
+            for name, size, mtime, stream in self.members( archive ):
+                if name in sandbox_set:
+                    sandbox.add( name, size, mtime, stream )
+                else:
+                    write_member( workspace, archive, name, mtime, stream )
+            sandbox.close( )
+        except AssertionError:
+            raise
+        except Exception as e:
+            raise AssertionError( 'Error extracting files', workspace, archive, e )
+
+
+external_archive = ExternalArchive( )
+internal_archive = InternalArchive( )
+
+def archive_backend( archive ):
+    ''' Return the backend for the archive. ArchiveBackend = auto (default) handles standard library formats
+        in-process and everything else with the ArchiveProgram; external always uses the ArchiveProgram. Whenever an
+        in-process probe, test or extraction fails the ArchiveProgram gets another try (see fall_back).
+    '''
+    if config.archive_backend != 'external' and internal_archive.handles( archive ):
+        return internal_archive
+    return external_archive
+
+def fall_back( archive, reason ):
+    logging.warn( "In-process {} failed for {}; retrying with {}.".format( reason, archive, config.zip_program ) )
+    internal_archive.reject( archive )
+
 def archive_context( archive ):
     ''' Return a context object that evaluates the archive list output. Returns:
             volumes: number of archive files in the fileset.
             sandbox: name of files to sandbox instead of extracting as a regular file.
         return_code: 0 indicates success.
     '''
-    return commandline( [ config.zip_program, 'l', '-bd', '-y',  archive ],
-                        [ 'Volumes = (?P<volumes>\d+)', '(?P<sandbox>keygen.exe)' ] )
+    with trace.span( 'probe', archive ):
+        backend = archive_backend( archive )
+        context = backend.context( archive )
+        if context.return_code and backend is internal_archive:
+            fall_back( archive, 'listing' )
+            context = external_archive.context( archive )
+        return context
 
 def archive_test( filename ):
-    context = commandline( [ config.zip_program, 't', '-bd', '-y', filename ] )
-    return context.return_code == 0
+    with trace.span( 'test', filename ):
+        backend = archive_backend( filename )
+        passed = backend.test( filename )
+        if not passed and backend is internal_archive:
+            fall_back( filename, 'test' )
+            passed = external_archive.test( filename )
+        trace.count( 'bytes_read', os.path.getsize( filename ) )
+    return passed
 
 def archive_fileset_filter( context, file_list, archive ):
     ''' Filter archive fileset from file_list.
@@ -389,41 +1391,27 @@ def extract_archive( context, workspace, archive ):
     ''' Extract files from archive into workspace. Sandboxed files are put into a password protected self-extracting
         archive.  
     '''
-    cmd =  [ config.zip_program, 'x', '-bd', '-y' ]
-    if hasattr( context, 'sandbox' ):
-        extract_and_sandbox( workspace, archive, context.sandbox )
-        cmd.append( '-x!{}'.format( context.sandbox ) )
-    cmd.append( '-o{}'.format( workspace ) )
-    cmd.append( archive )
-    context = commandline( cmd )
-    if context.return_code:
-        raise AssertionError( 'Error extracting files', workspace, archive )
-
-def extract_and_sandbox( workspace, archive, filename ):
-    ''' Extract file into a password protected self-extracting archive. The uncompressed file is never exposed to the
-        operating system (where a virus scanner may decide to quarantine the file). The file can later be uncompressed
-        and evaluated using a sandbox environment built for the task.
-    '''
-    path, ext = os.path.splitext( filename )
-    sandbox = os.path.join( workspace, '.7z'.join( [ path, ext ] ) )
-    include = '-i!{}'.format( filename )
-    inputname = '-si{}'.format( filename )
-    password = '-p{}'.format( config.sandbox_password )
-    xtract = subprocess.Popen( [ config.zip_program, 'x', '-bd', '-y', include, '-so', archive ],
-                               stdout = subprocess.PIPE, shell = False )
-    encode = subprocess.Popen( [ config.zip_program, 'a', '-bd', '-y', inputname, '-sfx7z.sfx', password, sandbox ],
-                               stdin = xtract.stdout, stdout = subprocess.PIPE, shell = False )
-    encode.communicate( )
-    if encode.returncode:
-        raise AssertionError( 'Error extracting file', filename )        
-    return archive
+    with trace.span( 'extract', archive ):
+        backend = archive_backend( archive )
+        try:
+            backend.extract( context, workspace, archive )
+        except Exception as e:
+            if backend is not internal_archive:
+                raise
+            fall_back( archive, 'extraction ({})'.format( e ) )
+            sandbox = Sandbox( workspace, archive ).filename
+            if os.path.exists( sandbox ):
+                os.remove( sandbox )
+            external_archive.extract( external_archive.context( archive ), workspace, archive )
+        trace.count( 'bytes_read', os.path.getsize( archive ) )
 
 def get_stack( basename ):
     ''' Return any stack attributes from the filename as a list of tuples [ ( matched string, tag, sequence ), ... ] 
     '''
     if not config.stacked_flag:
         return None
-    match_list = re.findall( config.re_stacked, basename, re.IGNORECASE )
+    match_list = [ ( m.group( 0 ), m.group( 'tag' ), m.group( 'sequence' ) )
+                   for m in config.stacked_pattern.finditer( basename ) ]
     if not match_list:
         return None
     return filter( lambda m: m[0], match_list )
@@ -436,7 +1424,10 @@ def set_stack( basename, stack ):
     '''
     if not stack:
         return basename
-    new_stack = filter( ( lambda s: s[1] != t[1] or s[2] != t[2] for t in get_stack( basename ) ), stack )
+    present = get_stack( basename ) or [ ]
+    new_stack = filter( lambda s: all( s[1] != t[1] or s[2] != t[2] for t in present ), stack )
+    if not new_stack:
+        return basename
     stack_string = '.'.join( map( lambda s: '-{}{}'.format( s[1], s[2] ), new_stack ) )
     name, ext = os.path.splitext( basename )
     return ''.join( [ name, '.', stack_string, ext ] )
@@ -458,9 +1449,15 @@ def handle_folder( storage, source, stack = None ):
     if not os.path.exists( source ):
         logging.warn( "Directory {0} does not exist. Skipping.".format( source ) )
         return
-    file_list = filter( ignore_filter, listdir( source ) )
+    with trace.span( 'scan', source ):
+        folder = classifier.scan( source )
+    if manifest:
+        manifest.filter( folder )
 
-    archive_list = filter( archive_filter, file_list )
+    archive_list = filter( archive_test, folder.archive )
+    # Files with an archive extension that are not archives (or are damaged) are copied as they are, except for
+    # subordinate volumes, which are dropped by the fileset filter of their first volume below.
+    folder.other.extend( archive for archive in folder.archive if archive not in archive_list )
     if len( archive_list ) > 0:
         ''' TODO: Should probably name the temporary directory using the archive name. May be useful when re-naming
                   media using the name of the containing folder. Currently no re-naming is done as that feature is
@@ -470,23 +1467,26 @@ def handle_folder( storage, source, stack = None ):
         for archive in archive_list:
             context = archive_context( archive )
             extract_archive( context, workspace, archive )
-            file_list = archive_fileset_filter( context, file_list, archive )
+            folder.media = archive_fileset_filter( context, folder.media, archive )
+            folder.subtitle = archive_fileset_filter( context, folder.subtitle, archive )
+            folder.meta = archive_fileset_filter( context, folder.meta, archive )
+            folder.other = archive_fileset_filter( context, folder.other, archive )
         handle_folder( storage, workspace, stack )
         shutil.rmtree( workspace )
 
-    for media in file_list:
-        handle_media( storage, os.path.join( source, media ), stack )
+    for media in folder.media + folder.other:
+        handle_media( storage, media, stack )
 
     if config.subtitle_flag:
-        for subtitle in filter( subtitle_filter, file_list ):
-            handle_media( storage, os.path.join( source, subtitle ), stack )
+        for subtitle in folder.subtitle:
+            handle_media( storage, subtitle, stack )
         
     if config.meta_flag:
-        for meta in filter( meta_filter, file_list ):
-            handle_media( storage, os.path.join( source, meta ), stack )
+        for meta in folder.meta:
+            handle_media( storage, meta, stack )
 
-    for folder in filter( os.path.isdir, listdir( source ) ):
-        handle_storage( storage, os.path.join( source, folder ) )
+    for subfolder in folder.folders:
+        handle_storage( storage, subfolder )
 
 def handle_media( storage_folder, source_fullname, stack = None ):
     ''' By default the storage will follow the same directory hierarchy as the source and will preserve source file
@@ -503,8 +1503,21 @@ def handle_media( storage_folder, source_fullname, stack = None ):
     logging.info( "Copy {} to {}".format( source_fullname, storage_fullname ) )
     if not os.path.exists( os.path.dirname( storage_fullname ) ) and not config.args.pretend:
         os.makedirs( os.path.dirname( storage_fullname ), 777 )
-    if not os.path.exists( storage_fullname ) and not config.args.pretend:
-        shutil.copy2( source_fullname, storage_fullname )
+    replace = manifest is not None and manifest.replaces( storage_fullname )
+    if ( replace or not os.path.exists( storage_fullname ) ) and not config.args.pretend:
+        temporary = storage_fullname + '.postprocess.tmp'
+        with trace.span( 'copy', source_fullname ):
+            copy_file( source_fullname, temporary )
+            if os.path.exists( storage_fullname ):
+                os.remove( storage_fullname )
+            os.rename( temporary, storage_fullname )
+        if manifest:
+            manifest.copied.append( fs_unicode( storage_fullname ) )
+        size = os.path.getsize( storage_fullname )
+        trace.count( 'files_copied' )
+        trace.count( 'bytes_copied', size )
+        trace.count( 'bytes_read', size )
+        trace.count( 'bytes_written', size )
 
 def make_parent( storage, filename ):
     ''' Some downloads are just a single bare media file. This function uses the media filename to formulate a parent
@@ -519,9 +1532,52 @@ def make_parent( storage, filename ):
     folder_name = '{}.[{}]'.format( match.group( 'folder'), match.group( 'year' ) )
     return os.path.join( storage, folder_name )
 
-config = Configuration( )
-if config.args.file:
-    handle_media( make_parent( config.storage_folder, config.args.file ),
-                  os.path.join( config.args.directory, config.args.file ) )
-else:
-    handle_storage( config.storage_folder, config.args.directory )
+def main( argv = None ):
+    ''' Load the configuration and process the completed download. argv defaults to sys.argv[1:] so the module can
+        also be driven from other scripts (see benchmark.py).
+    '''
+    global config, classifier, trace, manifest
+    trace = Trace( )
+    config = Configuration( argv )
+    classifier = Classifier( config )
+    if config.low_priority_io:
+        idle_io( )
+    profiler = cProfile.Profile( ) if config.args.profile else None
+    error = None
+    try:
+        if profiler:
+            profiler.enable( )
+        manifest = Manifest.Load( config.args )
+        if manifest and manifest.unchanged( ):
+            logging.info( "Torrent {} already processed into {}. Nothing changed.".format( config.args.infohash, manifest.storage ) )
+            if manifest.moved and not config.args.pretend:
+                manifest.save( manifest.storage )
+            return
+        if manifest and manifest.storage and os.path.isdir( manifest.storage ):
+            config.storage_folder = manifest.storage
+        else:
+            config.storage_folder = config.select_storage_folder( )
+        if config.args.file and manifest and not manifest.changed( os.path.join( config.args.directory, config.args.file ) ):
+            trace.count( 'files_skipped' )
+        elif config.args.file:
+            handle_media( make_parent( config.storage_folder, config.args.file ),
+                          os.path.join( config.args.directory, config.args.file ) )
+        else:
+            handle_storage( config.storage_folder, config.args.directory )
+        if manifest and not config.args.pretend:
+            manifest.save( config.storage_folder )
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        if profiler:
+            profiler.disable( )
+        trace.write( config.args, error, profiler )
+
+config = None
+classifier = None
+manifest = None
+trace = Trace( )
+
+if __name__ == "__main__":
+    main( )
@@ -0,0 +1,214 @@
+#!/usr/bin/python2
+
+'''
+Created on October 19, 2026
+
+@author: periwinklepreacher
+
+program name: storaged
+ description: Storage statistics service for the file server. Replaces disks.json.php,
+              which ran df -P and regex-parsed its output on every HTTP request.
+
+              A background thread samples statvfs for the configured mounts every
+              --interval seconds. Requests are answered from the last sample in the
+              same JSON format postprocess expects from StorageService:
+
+              [
+                  { "device" : "/dev/md0", "size" : 19236, "used" : 16460, "available" : 79576,
+                    "use" : "18%", "mount" : "/share/MOVIES01" },
+                  ...
+              ]
+
+              Sizes are 1024 byte blocks as reported by df -P. Responses carry an
+              ETag and Last-Modified header; conditional requests (If-None-Match,
+              If-Modified-Since) are answered with 304 Not Modified.
+
+              Long-poll: GET /disks.json?since=<etag>&wait=<seconds> blocks until the
+              snapshot differs from <etag> or the wait expires (then 304).
+
+       usage: storaged.py --port 8080 --mount '/share/MOVIES*' --mount /share/TV
+              StorageService = http://FileServer:8080/disks.json
+
+Copyright (C) 2026  periwinklepreacher.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from collections import OrderedDict
+import argparse
+import email.utils
+import glob
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import urlparse
+
+
+MAX_WAIT = 300
+
+
+def read_mounts( ):
+    ''' Return ( device, mount ) for every mounted file system listed in /proc/mounts.
+    '''
+    mounts = [ ]
+    with open( '/proc/mounts' ) as f:
+        for line in f:
+            fields = line.split( )
+            if len( fields ) >= 2:
+                mounts.append( ( fields[0], fields[1].decode( 'string_escape' ) ) )
+    return mounts
+
+
+class Sampler( threading.Thread ):
+    ''' Periodically sample statvfs for the selected mounts. Each sample that differs from the previous one becomes a
+        new snapshot with its own ETag and modification time; waiting requests are woken up.
+    '''
+    def __init__( self, patterns, interval ):
+        threading.Thread.__init__( self )
+        self.daemon = True
+        self.patterns = patterns
+        self.interval = interval
+        self.changed = threading.Condition( )
+        self.body = None
+        self.etag = None
+        self.modified = None
+        self.sample( )
+
+    def selected( self ):
+        mounts = read_mounts( )
+        if not self.patterns:
+            return mounts
+        paths = set( path for pattern in self.patterns for path in glob.glob( pattern ) )
+        return [ ( device, mount ) for device, mount in mounts if mount in paths ]
+
+    def sample( self ):
+        disk_list = [ ]
+        for device, mount in self.selected( ):
+            try:
+                stinfo = os.statvfs( mount )
+            except OSError:
+                continue
+            if not stinfo.f_blocks:
+                continue
+            size = stinfo.f_blocks * stinfo.f_frsize // 1024
+            used = ( stinfo.f_blocks - stinfo.f_bfree ) * stinfo.f_frsize // 1024
+            available = stinfo.f_bavail * stinfo.f_frsize // 1024
+            use = -( -used * 100 // ( used + available ) ) if used + available else 0
+            disk_list.append( OrderedDict( [ ( 'device', device ), ( 'size', size ), ( 'used', used ),
+                                             ( 'available', available ), ( 'use', '{}%'.format( use ) ),
+                                             ( 'mount', mount ) ] ) )
+        body = json.dumps( disk_list )
+        with self.changed:
+            if body != self.body:
+                self.body = body
+                self.etag = '"{}"'.format( hashlib.md5( body ).hexdigest( ) )
+                self.modified = int( time.time( ) )
+                self.changed.notify_all( )
+
+    def snapshot( self, since = None, wait = 0 ):
+        ''' Return ( body, etag, modified ). If since is the current ETag block for up to wait seconds for a change.
+        '''
+        deadline = time.time( ) + wait
+        with self.changed:
+            while since == self.etag and time.time( ) < deadline:
+                self.changed.wait( deadline - time.time( ) )
+            return self.body, self.etag, self.modified
+
+    def run( self ):
+        while True:
+            time.sleep( self.interval )
+            try:
+                self.sample( )
+            except Exception:
+                logging.exception( "Unable to sample storage." )
+
+
+class StorageServer( ThreadingMixIn, HTTPServer ):
+    daemon_threads = True
+
+    def __init__( self, address, sampler ):
+        HTTPServer.__init__( self, address, StorageHandler )
+        self.sampler = sampler
+
+
+class StorageHandler( BaseHTTPRequestHandler ):
+    def do_GET( self ):
+        query = urlparse.parse_qs( urlparse.urlparse( self.path ).query )
+        since = query.get( 'since', [ None ] )[0]
+        try:
+            wait = min( float( query.get( 'wait', [ 0 ] )[0] ), MAX_WAIT )
+        except ValueError:
+            wait = 0
+        body, etag, modified = self.server.sampler.snapshot( since, wait )
+
+        if self.not_modified( etag, modified ) or ( since is not None and since == etag ):
+            self.send_response( 304 )
+            self.send_headers( etag, modified )
+            self.end_headers( )
+            return
+        self.send_response( 200 )
+        self.send_header( 'Content-Type', 'application/json' )
+        self.send_header( 'Content-Length', str( len( body ) ) )
+        self.send_headers( etag, modified )
+        self.end_headers( )
+        self.wfile.write( body )
+
+    def not_modified( self, etag, modified ):
+        if_none_match = self.headers.get( 'If-None-Match' )
+        if if_none_match is not None:
+            return etag in [ tag.strip( ) for tag in if_none_match.split( ',' ) ] or if_none_match.strip( ) == '*'
+        if_modified_since = self.headers.get( 'If-Modified-Since' )
+        if if_modified_since:
+            since = email.utils.parsedate_tz( if_modified_since )
+            return since is not None and email.utils.mktime_tz( since ) >= modified
+        return False
+
+    def send_headers( self, etag, modified ):
+        self.send_header( 'ETag', etag )
+        self.send_header( 'Last-Modified', email.utils.formatdate( modified, usegmt = True ) )
+        self.send_header( 'Cache-Control', 'no-cache' )
+
+    def log_message( self, fmt, *args ):
+        logging.debug( "%s %s", self.address_string( ), fmt % args )
+
+
+def main( ):
+    parser = argparse.ArgumentParser( description = "Serve file system usage for postprocess StorageService." )
+    parser.add_argument( '--bind', default = '', help = "Address to listen on (default all)." )
+    parser.add_argument( '--port', type = int, default = 8080, help = "HTTP port." )
+    parser.add_argument( '--mount', action = 'append', default = [ ], help = "Glob of mount points to report (repeatable). Default is every mount." )
+    parser.add_argument( '--interval', type = float, default = 10.0, help = "Seconds between samples." )
+    parser.add_argument( '--level', choices = [ 'debug', 'info', 'warning', 'error' ], default = 'warning', help = "Console messages are filtered by this severity." )
+    args = parser.parse_args( )
+
+    logging.basicConfig( format = '%(asctime)s %(levelname)-8s %(message)s', datefmt = '%b-%d %H:%M:%S',
+                         level = getattr( logging, args.level.upper( ) ) )
+    sampler = Sampler( args.mount, args.interval )
+    sampler.start( )
+    server = StorageServer( ( args.bind, args.port ), sampler )
+    logging.info( "Serving {} mounts on port {}".format( len( json.loads( sampler.body ) ), args.port ) )
+    try:
+        server.serve_forever( )
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close( )
+
+if __name__ == "__main__":
+    main( )
@@ -31,6 +31,14 @@ Created on Aug 19, 2015
                ] )
                print( multicall ) 
 
+               fleet = Fleet( [ 'scgi://seedbox1:5000', ( 'scgi://seedbox2:5000', 30 ) ], timeout = 5 )
+               reply = fleet.d.multicall( 'main', 'd.get_hash=', 'd.get_name=' )
+               print( reply.rows( ) )     # [ [ 'scgi://seedbox1:5000', hash, name ], ... ]
+               print( reply.errors )      # instances that failed or did not answer in time
+
+               rtrpc.py --fleet hosts.txt -g get_down_rate
+               rtrpc.py --fleet hosts.txt -d main d.get_hash= d.get_name= d.get_ratio=
+
          env : rtorrent 0.9.2, libtorrent-0.13.2, xmlrpc-c 1.39.5, GCC 4.8.2
                Python 2.7.6, /usr/lib/python2.7/xmlrpc
 
@@ -61,11 +69,18 @@ from collections import OrderedDict
 import errno
 import re
 import socket
+import sys
+import threading
+import time
 import urllib
 import xmlrpclib
 import argparse
 
 class SCGITransport( xmlrpclib.Transport ):
+    def __init__( self, use_datetime = 0, timeout = None ):
+        xmlrpclib.Transport.__init__( self, use_datetime = use_datetime )
+        self.timeout = timeout
+
     def __repr__( self ):
         return ( '<SCGIServerProxy for %s%s>' % ( self.__host, self.__handler ) )
      
@@ -76,11 +91,11 @@ class SCGITransport( xmlrpclib.Transport ):
             host, port = urllib.splitport( host )
             addrinfo = socket.getaddrinfo( host, port, socket.AF_INET, socket.SOCK_STREAM )
             sd = socket.socket( *addrinfo[0][:3] )
-            sd.setblocking( True )
+            sd.settimeout( self.timeout )
             sd.connect( addrinfo[0][4] )
         else:
             sd = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
-            sd.setblocking( True )
+            sd.settimeout( self.timeout )
             sd.connect( handler )
         return sd
 
@@ -125,7 +140,7 @@ class SCGITransport( xmlrpclib.Transport ):
  
 class SCGIServerProxy( xmlrpclib.ServerProxy ):
     def __init__( self, uri, transport=None, encoding=None, verbose=False,
-                  allow_none=False, use_datetime=False ):
+                  allow_none=False, use_datetime=False, timeout=None ):
         protocol, uri = urllib.splittype( uri )
         if protocol not in ( 'scgi' ):
             raise IOError( 'Unsupported XML-RPC protocol' )
@@ -133,7 +148,7 @@ class SCGIServerProxy( xmlrpclib.ServerProxy ):
         if not self.__handler:
             self.__handler = '/'
         if transport is None:
-            transport = SCGITransport( use_datetime = use_datetime )
+            transport = SCGITransport( use_datetime = use_datetime, timeout = timeout )
         self.__transport = transport
          
         self.__encoding = encoding
@@ -171,6 +186,71 @@ class SCGIServerProxy( xmlrpclib.ServerProxy ):
             return self.__transport
         raise AttributeError( "Attribute %r not found" % ( attr, ) )
 
+class FleetReply( OrderedDict ):
+    ''' Results of one call keyed by instance, in fleet order, for the instances that answered. errors holds the
+        exception (socket.timeout when the instance did not answer in time) for the others.
+    '''
+    def __init__( self ):
+        OrderedDict.__init__( self )
+        self.errors = OrderedDict( )
+
+    def rows( self ):
+        ''' Merge list results such as d.multicall rows into one list, each row prefixed by its instance.
+        '''
+        return [ [ host ] + list( row ) for host, result in self.items( ) for row in result ]
+
+class Fleet( object ):
+    ''' Run the same XML-RPC call against several rtorrent instances concurrently. Hosts are SCGI URIs (or Unix
+        socket paths as accepted by SCGIServerProxy), optionally paired with their own timeout in seconds. Calls
+        are dispatched like SCGIServerProxy calls and return a FleetReply; an instance that fails or exceeds its
+        timeout only loses its own part of the reply.
+    '''
+    def __init__( self, hosts, timeout = 10.0 ):
+        self.__hosts = [ ( host, timeout ) if isinstance( host, basestring ) else ( host[0], float( host[1] ) )
+                         for host in hosts ]
+
+    @staticmethod
+    def Load( filename, timeout = 10.0 ):
+        ''' Read a hosts file: one "<uri> [timeout]" per line, blank lines and # comments are ignored.
+        '''
+        hosts = [ ]
+        with open( filename ) as f:
+            for line in f:
+                fields = line.split( '#', 1 )[0].split( )
+                if fields:
+                    hosts.append( ( fields[0], float( fields[1] ) if len( fields ) > 1 else timeout ) )
+        return Fleet( hosts, timeout )
+
+    def __request( self, methodname, params ):
+        outcome = { }
+        def call( host, timeout ):
+            try:
+                proxy = SCGIServerProxy( host, timeout = timeout )
+                outcome[ host ] = ( True, getattr( proxy, methodname )( *params ) )
+            except Exception as e:
+                outcome[ host ] = ( False, e )
+        start = time.time( )
+        threads = [ ]
+        for host, timeout in self.__hosts:
+            thread = threading.Thread( target = call, args = ( host, timeout ) )
+            thread.daemon = True
+            thread.start( )
+            threads.append( thread )
+        for thread, ( host, timeout ) in zip( threads, self.__hosts ):
+            thread.join( max( 0, start + timeout - time.time( ) ) )
+        reply = FleetReply( )
+        for host, timeout in self.__hosts:
+            succeeded, value = outcome.get( host, ( False, socket.timeout( 'No reply within {}s'.format( timeout ) ) ) )
+            if succeeded:
+                reply[ host ] = value
+            else:
+                reply.errors[ host ] = value
+        return reply
+
+    def __getattr__( self, name ):
+        # magic method dispatcher
+        return xmlrpclib._Method( self.__request, name )
+
 def dump_long( self, value, write ):
     if int( value ) > 2**31-1:
         write( "<value><i8>" )
@@ -183,22 +263,49 @@ def dump_long( self, value, write ):
 
 xmlrpclib.Marshaller.dispatch[int] = dump_long
 
+def unwrap( multicall ):
+    reply = multicall[0]
+    return reply[0] if isinstance( reply, list ) and len( reply ) == 1 else reply
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser( )
     parser.add_argument( '-H', '--host', default="scgi://localhost:5000" )
+    parser.add_argument( '--fleet', help="File of \"<uri> [timeout]\" lines; the call is run against every instance." )
+    parser.add_argument( '--timeout', type=float, default=None, help="Seconds to wait for each instance (fleet default 10)." )
     group = parser.add_mutually_exclusive_group( )
     group.add_argument( '-g', '--get' )
     group.add_argument( '-s', '--set', nargs=2 )
+    group.add_argument( '-d', '--download-list', dest='download_list', nargs='+', metavar=( 'VIEW', 'COMMAND' ),
+                        help="d.multicall over VIEW, e.g. -d main d.get_hash= d.get_name=" )
     args = parser.parse_args( )
 
-    proxy = SCGIServerProxy( args.host )
     if args.get:
-        multicall = proxy.system.multicall( [
-            { 'methodName': args.get, 'params': [ ] }
-        ] )
-        reply = multicall[0]
-        print( reply[0] if isinstance( reply, list ) and len( reply ) == 1 else reply )
+        calls = [ { 'methodName': args.get, 'params': [ ] } ]
+    elif args.set:
+        calls = [ { 'methodName': args.set[0], 'params': [ args.set[1] ] } ]
+
+    if args.fleet:
+        fleet = Fleet.Load( args.fleet, args.timeout or 10.0 )
+        if args.download_list:
+            reply = fleet.d.multicall( *args.download_list )
+            for row in reply.rows( ):
+                print( '\t'.join( unicode( field ) for field in row ).encode( 'UTF-8' ) )
+        elif args.get or args.set:
+            reply = fleet.system.multicall( calls )
+            if args.get:
+                for host, multicall in reply.items( ):
+                    print( '{}\t{}'.format( host, unwrap( multicall ) ) )
+        else:
+            parser.error( '--fleet needs one of -g, -s or -d' )
+        for host, error in reply.errors.items( ):
+            sys.stderr.write( '{}\terror: {}\n'.format( host, error ) )
+        sys.exit( 1 if reply.errors else 0 )
+
+    proxy = SCGIServerProxy( args.host, timeout = args.timeout )
+    if args.download_list:
+        for row in proxy.d.multicall( *args.download_list ):
+            print( '\t'.join( unicode( field ) for field in row ).encode( 'UTF-8' ) )
+    elif args.get:
+        print( unwrap( proxy.system.multicall( calls ) ) )
     elif args.set:
-        multicall = proxy.system.multicall( [
-            { 'methodName': args.set[0], 'params': [ args.set[1] ] }
-        ] )
+        multicall = proxy.system.multicall( calls )
@@ -0,0 +1,389 @@
+#!/usr/bin/python2
+
+'''
+Created on October 19, 2026
+
+@author: periwinklepreacher
+
+ program name: rtstats
+
+  description: Throughput history for rtorrent in a fixed amount of memory and disk.
+
+               The collector samples global up/down rates and, for every torrent,
+               up/down rates and connected peers in a single system.multicall. Samples
+               are averaged into several round-robin archives (e.g. 10 second rows for
+               six hours, one minute rows for a day, ten minute rows for a week and
+               hourly rows for a year) stored in one mmap'd file whose size is fixed
+               when it is created.
+
+               Per-torrent columns use a fixed number of slots. A torrent only gets a
+               slot once it transfers; it takes a free slot or the slot of the torrent
+               that has been idle the longest, never one that transferred in the same
+               sample. Rows written before a slot was (re)assigned are ignored by
+               queries.
+
+     examples: rtstats.py collect --host scgi://localhost:5000 --file ~/rtstats.rrd
+               rtstats.py query --file ~/rtstats.rrd --since 1d --percentile 95
+               rtstats.py query --file ~/rtstats.rrd --since 7d --top 10 --by up
+               rtstats.py query --file ~/rtstats.rrd --since 6h --hash 0123ABCD...
+
+         env : rtorrent 0.9.2, libtorrent-0.13.2, xmlrpc-c 1.39.5, GCC 4.8.2
+               Python 2.7.6
+
+ Copyright (C) 2026  periwinklepreacher.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from array import array
+import argparse
+import logging
+import math
+import mmap
+import os
+import re
+import signal
+import struct
+import sys
+import time
+
+from rtrpc import SCGIServerProxy
+
+
+MAGIC = 'RTS1'
+HEADER = struct.Struct( '<4sIII' )           # magic, version, slots, archives
+ARCHIVE = struct.Struct( '<II' )             # step seconds, rows
+SLOT = struct.Struct( '<40s64sII' )          # infohash, name, assigned, last seen
+FIELDS = 3                                   # up rate, down rate, peers
+DEFAULT_ARCHIVES = [ ( 10, 2160 ), ( 60, 1440 ), ( 600, 1008 ), ( 3600, 8760 ) ]
+
+
+class RoundRobin:
+    ''' Fixed size round-robin database backed by an mmap'd file.
+
+        Layout: header, archive definitions, slot table, then for each archive "rows" records of
+            uint32 timestamp, float32 global[ up, down, peers ], float32 slot[ slots ][ up, down, peers ]
+        A record belongs to the bucket starting at its timestamp; a zero timestamp marks an empty row.
+    '''
+    def __init__( self, filename, slots = 64, archives = DEFAULT_ARCHIVES, readonly = False ):
+        if not os.path.exists( filename ):
+            if readonly:
+                raise IOError( 'No such file', filename )
+            self.create( filename, slots, archives )
+        self.readonly = readonly
+        self.file = open( filename, 'rb' if readonly else 'r+b' )
+        self.map = mmap.mmap( self.file.fileno( ), 0, access = mmap.ACCESS_READ if readonly else mmap.ACCESS_WRITE )
+        magic, version, self.slots, count = HEADER.unpack_from( self.map, 0 )  # @UnusedVariable
+        if magic != MAGIC:
+            raise ValueError( 'Not an rtstats file', filename )
+        offset = HEADER.size
+        self.archives = [ ]
+        for i in range( count ):  # @UnusedVariable
+            self.archives.append( ARCHIVE.unpack_from( self.map, offset ) )
+            offset += ARCHIVE.size
+        self.slot_offset = offset
+        self.record = struct.Struct( '<I' + 'f' * FIELDS * ( 1 + self.slots ) )
+        offset += SLOT.size * self.slots
+        self.archive_offsets = [ ]
+        for step, rows in self.archives:  # @UnusedVariable
+            self.archive_offsets.append( offset )
+            offset += rows * self.record.size
+        self.slot_table = [ self.read_slot( i ) for i in range( self.slots ) ]
+        self.slot_index = dict( ( slot[0], i ) for i, slot in enumerate( self.slot_table ) if slot[0] )
+
+    @staticmethod
+    def create( filename, slots, archives ):
+        record_size = 4 + 4 * FIELDS * ( 1 + slots )
+        size = HEADER.size + ARCHIVE.size * len( archives ) + SLOT.size * slots + \
+               sum( rows * record_size for step, rows in archives )  # @UnusedVariable
+        with open( filename, 'wb' ) as f:
+            f.write( HEADER.pack( MAGIC, 1, slots, len( archives ) ) )
+            for step, rows in archives:
+                f.write( ARCHIVE.pack( step, rows ) )
+            f.truncate( size )
+
+    def close( self ):
+        if not self.readonly:
+            self.map.flush( )
+        self.map.close( )
+        self.file.close( )
+
+    def read_slot( self, index ):
+        infohash, name, assigned, last_seen = SLOT.unpack_from( self.map, self.slot_offset + SLOT.size * index )
+        return infohash.rstrip( '\0' ), name.rstrip( '\0' ), assigned, last_seen
+
+    def write_slot( self, index, infohash, name, assigned, last_seen ):
+        if isinstance( name, unicode ):
+            name = name.encode( 'UTF-8' )
+        self.slot_table[ index ] = ( infohash, name[:64], assigned, last_seen )
+        SLOT.pack_into( self.map, self.slot_offset + SLOT.size * index, infohash, name, assigned, last_seen )
+
+    def slot( self, infohash, name, now, busy = ( ) ):
+        ''' Return the slot for infohash, assigning a free slot or the one idle the longest. Slots in busy are never
+            reassigned; None is returned when every slot is busy.
+        '''
+        index = self.slot_index.get( infohash )
+        if index is None:
+            candidates = [ i for i in range( self.slots ) if i not in busy ]
+            if not candidates:
+                return None
+            index = min( candidates, key = lambda i: ( self.slot_table[i][0] != '', self.slot_table[i][3] ) )
+            old = self.slot_table[ index ][0]
+            if old:
+                del self.slot_index[ old ]
+                logging.info( "Slot {} reassigned from {} to {}".format( index, old, infohash ) )
+            self.slot_index[ infohash ] = index
+            self.write_slot( index, infohash, name, int( now ), int( now ) )
+        return index
+
+    def touch( self, index, now ):
+        infohash, name, assigned, last_seen = self.slot_table[ index ]  # @UnusedVariable
+        self.write_slot( index, infohash, name, assigned, int( now ) )
+
+    def write( self, archive, timestamp, values ):
+        step, rows = self.archives[ archive ]
+        row = ( timestamp // step ) % rows
+        self.record.pack_into( self.map, self.archive_offsets[ archive ] + row * self.record.size, timestamp, *values )
+
+    def rows( self, archive, start, end ):
+        ''' Yield ( timestamp, values ) for the non-empty rows of archive within [ start, end ) in time order.
+        '''
+        step, rows = self.archives[ archive ]
+        first = max( start // step, end // step - rows + 1 )
+        for bucket in xrange( int( first ), int( ( end - 1 ) // step ) + 1 ):
+            offset = self.archive_offsets[ archive ] + ( bucket % rows ) * self.record.size
+            timestamp = struct.unpack_from( '<I', self.map, offset )[0]
+            if timestamp == bucket * step:
+                yield timestamp, self.record.unpack_from( self.map, offset )[1:]
+
+    def archive_for( self, start, now = None ):
+        ''' Finest archive whose retention still reaches back to start, or the coarsest one. Retention counts back
+            from now rather than from the end of the window: older rows of a fine archive have been overwritten.
+        '''
+        now = time.time( ) if now is None else now
+        for i, ( step, rows ) in enumerate( self.archives ):
+            if now - start <= step * rows:
+                return i
+        return len( self.archives ) - 1
+
+
+class Collector:
+    ''' Average samples into every archive of the database. Accumulators are one bucket per archive, so memory use
+        does not depend on how long the collector runs.
+    '''
+    def __init__( self, database ):
+        self.db = database
+        width = FIELDS * ( 1 + database.slots )
+        self.buckets = [ None ] * len( database.archives )
+        self.sums = [ array( 'd', [ 0.0 ] ) * width for archive in database.archives ]  # @UnusedVariable
+        self.counts = [ 0 ] * len( database.archives )
+
+    def sample( self, proxy ):
+        ''' One round trip: global rates plus hash, name, rates and peers of every torrent.
+        '''
+        up, down, torrents = proxy.system.multicall( [
+            { 'methodName' : 'get_up_rate', 'params' : [ ] },
+            { 'methodName' : 'get_down_rate', 'params' : [ ] },
+            { 'methodName' : 'd.multicall', 'params' : [ 'main', 'd.get_hash=', 'd.get_name=', 'd.get_up_rate=',
+                                                         'd.get_down_rate=', 'd.get_peers_connected=' ] } ] )
+        return up[0], down[0], torrents[0]
+
+    def add( self, now, up, down, torrents ):
+        ''' Only torrents that are transferring get a slot. Torrents that already hold one are placed first and their
+            slots are marked busy, so a new torrent can only take the slot of one that is idle in this sample.
+        '''
+        values = array( 'd', [ 0.0 ] ) * ( FIELDS * ( 1 + self.db.slots ) )
+        values[0], values[1] = up, down
+        busy = set( )
+        placed = [ ]
+        waiting = [ ]
+        for infohash, name, t_up, t_down, peers in torrents:
+            values[2] += peers
+            index = self.db.slot_index.get( infohash )
+            if index is not None:
+                placed.append( ( index, t_up, t_down, peers ) )
+                if t_up or t_down:
+                    busy.add( index )
+                    self.db.touch( index, now )
+            elif t_up or t_down:
+                waiting.append( ( infohash, name, t_up, t_down, peers ) )
+        for infohash, name, t_up, t_down, peers in waiting:
+            index = self.db.slot( infohash, name, now, busy )
+            if index is None:
+                logging.debug( "No idle slot for {}".format( infohash ) )
+                continue
+            busy.add( index )
+            placed.append( ( index, t_up, t_down, peers ) )
+        # A reassigned slot appears twice; its new owner comes last and wins.
+        for index, t_up, t_down, peers in placed:
+            base = FIELDS * ( 1 + index )
+            values[ base ], values[ base + 1 ], values[ base + 2 ] = t_up, t_down, peers
+
+        for i, ( step, rows ) in enumerate( self.db.archives ):  # @UnusedVariable
+            bucket = int( now ) // step
+            if self.buckets[i] is not None and bucket != self.buckets[i]:
+                self.flush( i )
+            self.buckets[i] = bucket
+            sums = self.sums[i]
+            for j, value in enumerate( values ):
+                sums[j] += value
+            self.counts[i] += 1
+
+    def flush( self, archive = None ):
+        for i in ( [ archive ] if archive is not None else range( len( self.db.archives ) ) ):
+            if not self.counts[i]:
+                continue
+            step = self.db.archives[i][0]
+            count = float( self.counts[i] )
+            self.db.write( i, self.buckets[i] * step, [ s / count for s in self.sums[i] ] )
+            self.sums[i] = array( 'd', [ 0.0 ] ) * len( self.sums[i] )
+            self.counts[i] = 0
+
+    def run( self, proxy, interval ):
+        next_sample = time.time( )
+        try:
+            while True:
+                now = time.time( )
+                try:
+                    self.add( now, *self.sample( proxy ) )
+                except Exception as e:
+                    logging.warn( "Sample failed: {}".format( e ) )
+                next_sample += interval
+                time.sleep( max( 0, next_sample - time.time( ) ) )
+        finally:
+            self.flush( )
+
+
+class Query:
+    ''' Read-only views over a time window.
+    '''
+    def __init__( self, database, start, end ):
+        self.db = database
+        self.start = int( start )
+        self.end = int( end )
+        self.archive = database.archive_for( self.start )
+
+    def series( self, infohash = None ):
+        ''' List of ( timestamp, up, down, peers ) for the whole client or for one torrent.
+        '''
+        if infohash is None:
+            return [ ( t, v[0], v[1], v[2] ) for t, v in self.db.rows( self.archive, self.start, self.end ) ]
+        index = self.db.slot_index.get( infohash.upper( ) )
+        if index is None:
+            return [ ]
+        assigned = self.db.slot_table[ index ][2]
+        base = FIELDS * ( 1 + index )
+        return [ ( t, v[ base ], v[ base + 1 ], v[ base + 2 ] )
+                 for t, v in self.db.rows( self.archive, max( self.start, assigned ), self.end ) ]
+
+    def top( self, count = 10, by = 'up' ):
+        ''' Torrents with the highest average rate over the window as ( average, infohash, name ).
+        '''
+        field = 0 if by == 'up' else 1
+        totals = [ 0.0 ] * self.db.slots
+        counts = [ 0 ] * self.db.slots
+        for t, v in self.db.rows( self.archive, self.start, self.end ):
+            for index, ( infohash, name, assigned, last_seen ) in enumerate( self.db.slot_table ):  # @UnusedVariable
+                if infohash and t >= assigned:
+                    totals[ index ] += v[ FIELDS * ( 1 + index ) + field ]
+                    counts[ index ] += 1
+        ranked = sorted( ( ( total / max( 1, counts[ i ] ), self.db.slot_table[i][0], self.db.slot_table[i][1] )
+                           for i, total in enumerate( totals ) if total ), reverse = True )
+        return ranked[ :count ]
+
+
+def percentile( values, p ):
+    ''' Nearest-rank percentile of values (0 < p <= 100).
+    '''
+    if not values:
+        return 0.0
+    ordered = sorted( values )
+    return ordered[ max( 0, int( math.ceil( p / 100.0 * len( ordered ) ) ) - 1 ) ]
+
+def parse_duration( text ):
+    match = re.match( r'^(\d+(?:\.\d+)?)([smhdw]?)$', text )
+    if not match:
+        raise argparse.ArgumentTypeError( 'Expected a duration like 90s, 15m, 6h, 7d or 2w' )
+    return float( match.group( 1 ) ) * { '' : 1, 's' : 1, 'm' : 60, 'h' : 3600, 'd' : 86400, 'w' : 604800 }[ match.group( 2 ) ]
+
+def parse_archives( text ):
+    return [ tuple( int( n ) for n in spec.split( 'x' ) ) for spec in text.split( ',' ) ]
+
+def human( rate ):
+    for unit in [ 'B/s', 'KB/s', 'MB/s' ]:
+        if abs( rate ) < 1024:
+            return '{:.1f} {}'.format( rate, unit )
+        rate /= 1024.0
+    return '{:.1f} GB/s'.format( rate )
+
+def query( args ):
+    db = RoundRobin( args.file, readonly = True )
+    end = time.time( ) - ( args.until or 0 )
+    q = Query( db, end - args.since, end )
+    step = db.archives[ q.archive ][0]
+    if args.top:
+        print( '{:>12}  {:<40}  {}'.format( 'avg ' + args.by, 'infohash', 'name' ) )
+        for average, infohash, name in q.top( args.top, args.by ):
+            print( '{:>12}  {:<40}  {}'.format( human( average ), infohash, name ) )
+        return
+    series = q.series( args.hash )
+    if not series:
+        print( 'No data.' )
+        return
+    if args.percentile:
+        print( 'p{:g} over {} rows of {}s: up {} down {} peers {:.0f}'.format(
+            args.percentile, len( series ), step,
+            human( percentile( [ s[1] for s in series ], args.percentile ) ),
+            human( percentile( [ s[2] for s in series ], args.percentile ) ),
+            percentile( [ s[3] for s in series ], args.percentile ) ) )
+        return
+    for timestamp, up, down, peers in series:
+        print( '{}  up {:>12}  down {:>12}  peers {:>5.0f}'.format(
+            time.strftime( '%Y-%m-%d %H:%M:%S', time.localtime( timestamp ) ), human( up ), human( down ), peers ) )
+
+def collect( args ):
+    db = RoundRobin( args.file, args.slots, args.archives )
+    signal.signal( signal.SIGTERM, lambda signum, frame: sys.exit( 0 ) )
+    try:
+        Collector( db ).run( SCGIServerProxy( args.host ), args.interval )
+    except KeyboardInterrupt:
+        pass
+    finally:
+        db.close( )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser( )
+    parser.add_argument( '--file', default = os.path.expanduser( '~/rtstats.rrd' ), help = "Round-robin database file." )
+    subparsers = parser.add_subparsers( )
+    collector = subparsers.add_parser( 'collect', help = "Sample rtorrent into the database." )
+    collector.add_argument( '-H', '--host', default = "scgi://localhost:5000" )
+    collector.add_argument( '--interval', type = float, default = 10, help = "Seconds between samples." )
+    collector.add_argument( '--slots', type = int, default = 64, help = "Torrent columns (only used when creating the file)." )
+    collector.add_argument( '--archives', type = parse_archives, default = DEFAULT_ARCHIVES,
+                            help = "Resolutions as <step seconds>x<rows>,... (only used when creating the file)." )
+    collector.add_argument( '--level', choices = [ 'debug', 'info', 'warning', 'error' ], default = 'warning' )
+    collector.set_defaults( func = collect )
+    reader = subparsers.add_parser( 'query', help = "Report rates from the database." )
+    reader.add_argument( '--since', type = parse_duration, default = parse_duration( '1h' ), help = "Window length, e.g. 6h." )
+    reader.add_argument( '--until', type = parse_duration, default = 0, help = "Window ends this long ago." )
+    reader.add_argument( '--hash', default = None, help = "Report a single torrent." )
+    reader.add_argument( '--percentile', type = float, default = None, help = "Print this percentile instead of the series." )
+    reader.add_argument( '--top', type = int, default = None, help = "List the busiest torrents." )
+    reader.add_argument( '--by', choices = [ 'up', 'down' ], default = 'up' )
+    reader.set_defaults( func = query, level = 'warning' )
+    args = parser.parse_args( )
+
+    logging.basicConfig( format = '%(asctime)s %(levelname)-8s %(message)s', datefmt = '%b-%d %H:%M:%S',
+                         level = getattr( logging, args.level.upper( ) ) )
+    args.func( args )
@@ -0,0 +1,316 @@
+#!/usr/bin/python2
+
+'''
+Created on October 19, 2026
+
+@author: periwinklepreacher
+
+ program name: rtwatch
+
+  description: Event-driven completion feed for rtorrent. Runs postprocess (or any
+               other command) as soon as a download finishes, without polling
+               d.multicall for every torrent.
+
+               On start an event.download.finished handler is installed through
+               XML-RPC. The handler makes rtorrent run this script with --notify,
+               which sends the infohash as a datagram to a local Unix socket. If the
+               handler cannot be installed the watcher falls back to polling only
+               d.get_hash/d.get_complete every --interval seconds; with the handler
+               installed the same poll runs every --safety-interval seconds.
+
+               Infohashes whose command has run are kept in the --state file. The
+               first poll after a start runs the command for every completed torrent
+               not in it, so completions that happened while the watcher was down
+               are not lost. Without a state file the first poll only records the
+               torrents that are already complete.
+
+               Each finished torrent is handed to --command one at a time, with the
+               same fields uTorrent passes to its "run program" setting:
+                   %D directory   %N name   %L label (d.get_custom1)   %I infohash
+                   %F file name (single file torrents only, otherwise empty)
+
+     examples: rtwatch.py --host scgi://localhost:5000 --socket /tmp/rtwatch.sock \
+                   --command 'python2 /opt/postprocess/postprocess.py -f %F -d %D -t %N -l %L -i %I'
+
+         env : rtorrent 0.9.2, libtorrent-0.13.2, xmlrpc-c 1.39.5, GCC 4.8.2
+               Python 2.7.6
+
+ Copyright (C) 2026  periwinklepreacher.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import Queue
+import argparse
+import errno
+import logging
+import os
+import select
+import shlex
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from rtrpc import SCGIServerProxy
+
+
+HANDLER_NAME = 'rtwatch'
+FS_ENCODING = sys.getfilesystemencoding( ) or 'utf-8'
+
+
+def fs_bytes( value ):
+    ''' xmlrpclib returns unicode for non-ASCII strings; encode them for logging and for the command line.
+    '''
+    if not isinstance( value, unicode ):
+        return value
+    try:
+        return value.encode( FS_ENCODING )
+    except UnicodeEncodeError:
+        return value.encode( 'utf-8' )
+
+
+class Torrent:
+    ''' Fields of a finished download in the shape of uTorrent's %D %N %L %I %F arguments.
+    '''
+    def __init__( self, infohash, directory, name, label, multi_file ):
+        infohash, directory, name, label = [ fs_bytes( value ) for value in ( infohash, directory, name, label ) ]
+        self.infohash = infohash
+        self.directory = directory
+        self.name = name
+        self.label = label
+        self.file = '' if multi_file else name
+
+    def fields( self ):
+        return { '%D' : self.directory, '%N' : self.name, '%L' : self.label, '%I' : self.infohash, '%F' : self.file }
+
+
+class State:
+    ''' Infohashes whose completion command has run, one per line. hashes is None until the file exists.
+    '''
+    def __init__( self, filename ):
+        self.filename = filename
+        self.lock = threading.Lock( )
+        self.hashes = None
+        if os.path.isfile( filename ):
+            with open( filename ) as f:
+                self.hashes = set( line.strip( ) for line in f if line.strip( ) )
+
+    def save( self ):
+        temporary = self.filename + '.tmp'
+        with open( temporary, 'w' ) as f:
+            f.writelines( infohash + '\n' for infohash in sorted( self.hashes ) )
+        os.rename( temporary, self.filename )
+
+    def update( self, add = ( ), keep = None ):
+        ''' Add infohashes and, when keep is given, forget those no longer in rtorrent so the file does not grow.
+        '''
+        with self.lock:
+            self.hashes = ( self.hashes or set( ) ) | set( add )
+            if keep is not None:
+                self.hashes &= keep
+            try:
+                self.save( )
+            except ( IOError, OSError ) as e:
+                logging.error( "Unable to save state {}: {}".format( self.filename, e ) )
+
+
+class Runner( threading.Thread ):
+    ''' Run the completion command for queued torrents one at a time so that large copies do not compete with each
+        other for the disk. A torrent is recorded in the state once its command has run.
+    '''
+    def __init__( self, command, state ):
+        threading.Thread.__init__( self )
+        self.daemon = True
+        self.command = shlex.split( command )
+        self.state = state
+        self.queue = Queue.Queue( )
+
+    def argv( self, torrent ):
+        fields = torrent.fields( )
+        argv = [ ]
+        for arg in self.command:
+            for token, value in fields.items( ):
+                arg = arg.replace( token, value )
+            argv.append( arg )
+        return argv
+
+    def run( self ):
+        while True:
+            torrent = self.queue.get( )
+            try:
+                self.execute( torrent )
+            except Exception:
+                logging.exception( "Unable to process {}".format( torrent.infohash ) )
+
+    def execute( self, torrent ):
+        argv = self.argv( torrent )
+        logging.info( "Running {}".format( ' '.join( argv ) ) )
+        start = time.time( )
+        try:
+            return_code = subprocess.call( argv, shell = False )
+            logging.info( "{} finished with {} after {:.1f}s".format( torrent.name, return_code, time.time( ) - start ) )
+        except OSError as e:
+            logging.error( "Unable to run {}: {}".format( argv[0], e ) )
+            return
+        self.state.update( add = [ torrent.infohash ] )
+
+
+class Watcher:
+    ''' Wait for completion notifications on the Unix socket, poll as a safety net, and queue finished torrents on
+        the runner. Each infohash is queued once per completion.
+    '''
+    def __init__( self, host, socket_path, runner, interval, safety_interval ):
+        self.proxy = SCGIServerProxy( host )
+        self.socket_path = socket_path
+        self.runner = runner
+        self.interval = interval
+        self.safety_interval = safety_interval
+        self.complete = None
+        self.handler = False
+        self.sd = None
+
+    def bind( self ):
+        if os.path.exists( self.socket_path ):
+            os.remove( self.socket_path )
+        self.sd = socket.socket( socket.AF_UNIX, socket.SOCK_DGRAM )
+        self.sd.bind( self.socket_path )
+        os.chmod( self.socket_path, 0o660 )
+
+    def install( self ):
+        ''' Install the event.download.finished handler. rtorrent runs this script with --notify and the infohash.
+        '''
+        command = ','.join( [ 'execute.nothrow.bg=' + sys.executable, os.path.abspath( __file__ ),
+                              '--notify', self.socket_path, '$d.get_hash=' ] )
+        try:
+            self.proxy.method.set_key( 'event.download.finished', HANDLER_NAME, command )
+            self.handler = True
+            logging.info( "Installed event.download.finished handler {}".format( HANDLER_NAME ) )
+        except Exception as e:
+            self.handler = False
+            logging.warn( "Unable to install completion handler ({}). Polling every {}s.".format( e, self.interval ) )
+
+    def uninstall( self ):
+        if not self.handler:
+            return
+        try:
+            self.proxy.method.set_key( 'event.download.finished', HANDLER_NAME )
+        except Exception as e:
+            logging.warn( "Unable to remove completion handler: {}".format( e ) )
+
+    def poll( self ):
+        ''' Fetch only hash and completion state for all torrents and queue the ones that completed since the last
+            poll. The first poll queues completed torrents missing from the state instead, or records them all when
+            there is no state yet.
+        '''
+        try:
+            rows = self.proxy.d.multicall( 'main', 'd.get_hash=', 'd.get_complete=' )
+        except Exception as e:
+            logging.warn( "Poll failed: {}".format( e ) )
+            return
+        complete = set( infohash for infohash, done in rows if done )
+        if self.complete is None:
+            state = self.runner.state
+            if state.hashes is None:
+                logging.info( "No state yet. Recording {} completed torrents as processed.".format( len( complete ) ) )
+                state.update( add = complete )
+            state.update( keep = set( infohash for infohash, done in rows ) )  # @UnusedVariable
+            pending = complete - state.hashes
+        else:
+            pending = complete - self.complete
+        for infohash in pending:
+            self.finished( infohash )
+        self.complete = complete
+
+    def finished( self, infohash ):
+        if self.complete is not None and infohash in self.complete:
+            return
+        try:
+            directory, name, label, multi_file = [ reply[0] for reply in self.proxy.system.multicall( [
+                { 'methodName' : method, 'params' : [ infohash ] } for method in
+                [ 'd.get_directory', 'd.get_name', 'd.get_custom1', 'd.is_multi_file' ] ] ) ]
+        except Exception as e:
+            logging.error( "Unable to fetch details for {}: {}".format( infohash, e ) )
+            return
+        torrent = Torrent( infohash, directory, name, label, multi_file )
+        if self.complete is not None:
+            self.complete.add( infohash )
+        logging.info( "Finished {} ({})".format( torrent.name, infohash ) )
+        self.runner.queue.put( torrent )
+
+    def serve( self ):
+        self.bind( )
+        self.install( )
+        self.poll( )
+        interval = self.safety_interval if self.handler else self.interval
+        deadline = time.time( ) + interval
+        try:
+            while True:
+                try:
+                    readable = select.select( [ self.sd ], [ ], [ ], max( 0, deadline - time.time( ) ) )[0]
+                except select.error as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                if readable:
+                    infohash = self.sd.recv( 256 ).strip( )
+                    if infohash:
+                        self.finished( infohash )
+                if time.time( ) >= deadline:
+                    self.poll( )
+                    deadline = time.time( ) + interval
+        finally:
+            self.uninstall( )
+            self.sd.close( )
+            os.remove( self.socket_path )
+
+
+def notify( socket_path, infohash ):
+    ''' Called by rtorrent's event handler: forward the infohash to the watcher.
+    '''
+    sd = socket.socket( socket.AF_UNIX, socket.SOCK_DGRAM )
+    try:
+        sd.sendto( infohash, socket_path )
+    finally:
+        sd.close( )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser( )
+    parser.add_argument( '-H', '--host', default = "scgi://localhost:5000" )
+    parser.add_argument( '--socket', default = '/tmp/rtwatch.sock', help = "Unix socket the completion handler notifies." )
+    parser.add_argument( '--state', default = os.path.expanduser( '~/.rtwatch.state' ), help = "File of infohashes whose command has run." )
+    parser.add_argument( '--command', help = "Command run for each finished torrent; %%D %%N %%L %%I %%F are replaced." )
+    parser.add_argument( '--interval', type = float, default = 10, help = "Poll interval when no handler could be installed." )
+    parser.add_argument( '--safety-interval', dest = 'safety_interval', type = float, default = 300, help = "Poll interval when the handler is installed." )
+    parser.add_argument( '--notify', nargs = 2, metavar = ( 'SOCKET', 'HASH' ), help = "Internal: used by the rtorrent handler." )
+    parser.add_argument( '--level', choices = [ 'debug', 'info', 'warning', 'error' ], default = 'info' )
+    args = parser.parse_args( )
+
+    if args.notify:
+        notify( *args.notify )
+        sys.exit( 0 )
+    if not args.command:
+        parser.error( '--command is required' )
+
+    logging.basicConfig( format = '%(asctime)s %(levelname)-8s %(message)s', datefmt = '%b-%d %H:%M:%S',
+                         level = getattr( logging, args.level.upper( ) ) )
+    signal.signal( signal.SIGTERM, lambda signum, frame: sys.exit( 0 ) )
+    runner = Runner( args.command, State( args.state ) )
+    runner.start( )
+    try:
+        Watcher( args.host, args.socket, runner, args.interval, args.safety_interval ).serve( )
+    except KeyboardInterrupt:
+        pass